@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmarks for tx_tokyo. Run as:
+
+    python bench_tx_tokyo.py [name ...]
+
+Without names all benchmarks are run. Server benchmarks talk to an
+in-process fake ttserver (tx_tokyo_fake) over loopback TCP, so they need
+no external service; client and server share the process and its CPU.
+"""
+
+import struct
+import sys
+import timeit
+
+from twisted.internet import defer, protocol, reactor
+
+from tx_tokyo import MAGIC_NUMBER, ENCODING, TyrantProtocol, _pack
+from tx_tokyo import _pack_parts, compile_query, MetricsCollector
+from tx_tokyo_fake import FakeTyrantFactory
+
+
+def _pack_reference(code, *args):
+    # _pack as it was before precompiled headers, kept for comparison
+    buf = ''
+    fmt = '>BB'
+    largs = []
+    for arg in args:
+        if isinstance(arg, int):
+            fmt += 'I'
+            largs.append(arg)
+
+        elif isinstance(arg, str):
+            buf += arg
+
+        elif isinstance(arg, unicode):
+            buf += arg.encode(ENCODING)
+        
+        elif isinstance(arg, long):
+            fmt += 'Q'
+            largs.append(arg)
+
+        elif isinstance(arg, (list, tuple)):
+            for v in arg:
+                v = str(v)
+                buf += "%s%s" % (struct.pack(">I", len(v)), v)
+
+    return "%s%s" % (struct.pack(fmt, MAGIC_NUMBER, code, *largs), buf)
+
+
+def report(name, seconds, ops):
+    print "%-40s %12.0f ops/s %10.2f us/op" % (name, ops / seconds,
+                                                seconds * 1e6 / ops)
+
+
+def best(func, number, repeat=3):
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def report_latency(name, seconds, ops, latencies):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+    print "%-40s %12.0f ops/s %10.2f us p50 %10.2f us p99" % (
+        name, ops / seconds, p50 * 1e6, p99 * 1e6)
+
+
+@defer.inlineCallbacks
+def connect(dbtype='hash', latency=0, chunk_size=None):
+    """Fake server and a connected TyrantProtocol"""
+    factory = FakeTyrantFactory(dbtype, latency, chunk_size)
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    creator = protocol.ClientCreator(reactor, TyrantProtocol)
+    proto = yield creator.connectTCP('127.0.0.1', port.getHost().port)
+    defer.returnValue((port, proto))
+
+
+@defer.inlineCallbacks
+def disconnect(port, proto):
+    proto.transport.loseConnection()
+    yield port.stopListening()
+
+
+@defer.inlineCallbacks
+def timed(name, calls, window=1):
+    """Run calls (functions returning deferreds) keeping up to window of
+    them in flight, report throughput and latency"""
+    clock = timeit.default_timer
+    latencies = []
+    calls = iter(calls)
+
+    @defer.inlineCallbacks
+    def worker():
+        for call in calls:
+            start = clock()
+            yield call()
+            latencies.append(clock() - start)
+
+    start = clock()
+    yield defer.gatherResults([worker() for i in xrange(window)])
+    report_latency(name, clock() - start, len(latencies), latencies)
+
+
+def bench_pack():
+    """_pack against the previous implementation"""
+    key, value = 'key:12345', 'v' * 100
+    put_args = (TyrantProtocol.PUT, len(key), len(value), key, value)
+    items = []
+    for i in xrange(20000):
+        items.extend(('key:%d' % i, 'value:%d' % i))
+    putlist_args = (TyrantProtocol.MISC, len('putlist'), 0, len(items),
+                    'putlist', items)
+    assert _pack(*put_args) == _pack_reference(*put_args)
+    assert _pack(*putlist_args) == _pack_reference(*putlist_args)
+
+    for name, args, number in (('put', put_args, 100000),
+                               ('putlist 20000 items', putlist_args, 20)):
+        for impl in (_pack_reference, _pack):
+            seconds = best(lambda: impl(*args), number)
+            report("%s %s" % (impl.__name__, name), seconds, number)
+
+
+def _search_reference(conditions, limit, offset, order_type, order_field,
+                      columns):
+    # Search request as it was built before compiled queries
+    args = ["addcond\x00%s\x00%d\x00%s" % cond for cond in conditions]
+    if order_field:
+        args += ['setorder\x00%s\x00%d' % (order_field, order_type)]
+    if limit > 0 and offset >= 0:
+        args += ['setlimit\x00%d\x00%d' % (limit, offset)]
+    if columns is not None:
+        args += ['\x00'.join(['get'] + list(columns))]
+    return _pack(TyrantProtocol.MISC, len('search'), 0, len(args), 'search',
+                 args)
+
+
+def _search_compiled(conditions, limit, offset, order_type, order_field,
+                     columns):
+    query = compile_query(conditions, order_type, order_field, columns)
+    nargs, payload = query.args(limit, offset)
+    return ''.join(_pack_parts(TyrantProtocol.MISC, len('search'), 0, nargs,
+                               'search', *payload))
+
+
+def bench_query_plan():
+    """Encoding of a repeated search, compiled query against building it"""
+    conditions = [('name', TyrantProtocol.RDBQCSTREQ, u'Reflejo'),
+                  ('test', TyrantProtocol.RDBQCNUMGT, 0),
+                  ('city', TyrantProtocol.RDBQCSTRBW, u'Buenos')]
+    args = (conditions, 10, 20, TyrantProtocol.RDBQOSTRASC, 'name',
+            ['name', 'test'])
+    assert _search_compiled(*args) == _search_reference(*args)
+
+    number = 100000
+    results = []
+    for impl in (_search_reference, _search_compiled):
+        seconds = best(lambda: impl(*args), number)
+        report(impl.__name__.lstrip('_'), seconds, number)
+        results.append(seconds)
+    print "%-40s %12.2f us/query" % ('saved',
+                                     (results[0] - results[1]) * 1e6 / number)
+
+
+@defer.inlineCallbacks
+def bench_single():
+    """Single put and get, one at a time"""
+    port, proto = yield connect()
+    n = 5000
+    value = 'v' * 100
+    yield timed('put', (lambda i=i: proto.put('key:%d' % i, value)
+                        for i in xrange(n)))
+    yield timed('get', (lambda i=i: proto.get('key:%d' % i)
+                        for i in xrange(n)))
+    yield disconnect(port, proto)
+
+
+@defer.inlineCallbacks
+def bench_pipelined():
+    """Gets with 100 in flight on one connection, with server latency"""
+    for latency, chunk_size in ((0, None), (0, 16), (0.001, None)):
+        port, proto = yield connect(latency=latency, chunk_size=chunk_size)
+        n = 20000
+        yield proto.misc('putlist', sum((['key:%d' % i, 'v' * 100]
+                                         for i in xrange(1000)), []))
+        yield timed('get latency %gms chunks %s' % (latency * 1000,
+                                                    chunk_size),
+                    (lambda i=i: proto.get('key:%d' % (i % 1000), True)
+                     for i in xrange(n)), window=100)
+        yield disconnect(port, proto)
+
+
+@defer.inlineCallbacks
+def bench_bulk():
+    """putlist and getlist of 1000 records per call"""
+    port, proto = yield connect()
+    batches = []
+    for b in xrange(50):
+        items = []
+        for i in xrange(b * 1000, (b + 1) * 1000):
+            items.extend(('key:%d' % i, 'v' * 100))
+        batches.append(items)
+    yield timed('putlist 1000', (lambda b=b: proto.misc('putlist', b)
+                                 for b in batches))
+    yield timed('getlist 1000', (lambda b=b: proto.misc('getlist', b[::2])
+                                 for b in batches))
+    yield disconnect(port, proto)
+
+
+@defer.inlineCallbacks
+def bench_large():
+    """Put and get of 1MB values"""
+    port, proto = yield connect()
+    value = 'v' * (1024 * 1024)
+    n = 50
+    yield timed('put 1MB', (lambda i=i: proto.put('big:%d' % i, value)
+                            for i in xrange(n)))
+    yield timed('get 1MB', (lambda i=i: proto.get('big:%d' % i, True)
+                            for i in xrange(n)))
+    yield disconnect(port, proto)
+
+
+@defer.inlineCallbacks
+def bench_scatter():
+    """Put of 1MB and 4MB values, joined or passed to writeSequence"""
+    port, proto = yield connect()
+    n = 20
+    for size in (1, 4):
+        value = 'v' * (size * 1024 * 1024)
+        for scatter_size in (sys.maxint, TyrantProtocol.scatter_size):
+            proto.scatter_size = scatter_size
+            path = 'joined' if scatter_size == sys.maxint else 'scattered'
+            for window in (1, 4):
+                yield timed('put %dMB %s window %d' % (size, path, window),
+                            (lambda i=i: proto.put('big:%d' % i, value)
+                             for i in xrange(n)), window)
+    del proto.scatter_size
+    yield disconnect(port, proto)
+
+
+def bench_metrics():
+    """Get sent and its reply decoded, without and with metrics"""
+    from twisted.test.proto_helpers import StringTransport
+    reply = '\x00' + struct.pack('>I', 100) + 'v' * 100
+    number = 50000
+    for metrics in (None, MetricsCollector()):
+        proto = TyrantProtocol()
+        proto.coalesce = False
+        proto.metrics = metrics
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        def get():
+            proto.get('key:12345')
+            proto.dataReceived(reply)
+            transport.clear()
+        seconds = best(get, number)
+        report("get metrics %s" % (metrics.__class__.__name__
+                                   if metrics else 'off'), seconds, number)
+
+
+BENCHMARKS = [
+    ('pack', bench_pack),
+    ('query_plan', bench_query_plan),
+    ('metrics', bench_metrics),
+]
+
+# Benchmarks returning deferreds, run with the reactor
+SERVER_BENCHMARKS = [
+    ('single', bench_single),
+    ('pipelined', bench_pipelined),
+    ('bulk', bench_bulk),
+    ('large', bench_large),
+    ('scatter', bench_scatter),
+]
+
+
+@defer.inlineCallbacks
+def run_server(benchmarks):
+    try:
+        for name, bench in benchmarks:
+            print "== %s: %s" % (name, bench.__doc__)
+            yield bench()
+    finally:
+        reactor.stop()
+
+
+def main(names):
+    for name, bench in BENCHMARKS:
+        if not names or name in names:
+            print "== %s: %s" % (name, bench.__doc__)
+            bench()
+    server = [(name, bench) for name, bench in SERVER_BENCHMARKS
+              if not names or name in names]
+    if server:
+        reactor.callWhenRunning(run_server, server)
+        reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
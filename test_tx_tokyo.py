@@ -0,0 +1,797 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Tests of tx_tokyo and tx_pytokyo against the fake ttserver of tx_tokyo_fake.
+Run with trial:
+
+    trial test_tx_tokyo
+"""
+
+import collections
+
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.trial import unittest
+
+from tx_tokyo import TyrantProtocol, TyrantFactory, TyrantPool, TyrantShards
+from tx_tokyo import TyrantReplicas, BatchingProtocol, CircuitBreaker
+from tx_tokyo import SearchCursor, ConnectionPoisoned, CircuitOpen
+from tx_tokyo import KeyIterator, CachingProtocol, LRUCache, TyrantError
+from tx_tokyo import PrefixScanner, CompiledQuery, compile_query, BulkLoader
+from tx_tokyo import MetricsCollector
+import tx_tokyo
+from tx_tokyo_fake import FakeTyrant, FakeTyrantFactory
+from tx_pytokyo import Tyrant, Query, Record
+
+# Client connections opened by the running test
+_opened = []
+
+
+class _Protocol(TyrantProtocol):
+    """Client connection which tells when its socket is closed"""
+
+    def connectionMade(self):
+        TyrantProtocol.connectionMade(self)
+        self.closed = defer.Deferred()
+        _opened.append(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        TyrantProtocol.connectionLost(self, reason)
+        self.closed.callback(None)
+
+
+class _Factory(TyrantFactory):
+    protocol = _Protocol
+
+
+class _Pool(TyrantPool):
+    factory = _Factory
+
+
+class _FakeTyrant(FakeTyrant):
+    """Server side connection which tells when it is closed"""
+
+    def connectionMade(self):
+        FakeTyrant.connectionMade(self)
+        self.closed = defer.Deferred()
+        self.factory.opened.append(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        FakeTyrant.connectionLost(self, reason)
+        self.closed.callback(None)
+
+
+class _FakeTyrantFactory(FakeTyrantFactory):
+    protocol = _FakeTyrant
+
+    def __init__(self, *args, **kwargs):
+        FakeTyrantFactory.__init__(self, *args, **kwargs)
+        self.opened = []
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """Runs servers of dbtype with latency and chunk_size, connections and
+    pools made by the test are closed after it"""
+
+    dbtype = 'hash'
+    latency = 0
+    chunk_size = None
+    timeout = 10
+
+    def setUp(self):
+        del _opened[:]
+        self.servers = []
+        self.pools = []
+        self.port = self.listen()
+
+    def listen(self):
+        server = _FakeTyrantFactory(self.dbtype, self.latency,
+                                    self.chunk_size)
+        port = reactor.listenTCP(0, server, interface='127.0.0.1')
+        self.servers.append((server, port))
+        return port.getHost().port
+
+    def connect(self, port=None, pipeline_depth=None, timeout=None):
+        creator = protocol.ClientCreator(reactor, _Protocol, pipeline_depth,
+                                         timeout)
+        return creator.connectTCP('127.0.0.1', port or self.port)
+
+    def pool(self, port=None, **kwargs):
+        pool = _Pool('127.0.0.1', port or self.port, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.disconnect()
+        ds = []
+        for proto in _opened:
+            if proto.transport.connected:
+                proto.transport.loseConnection()
+            ds.append(proto.closed)
+        for server, port in self.servers:
+            ds.extend(conn.closed for conn in server.opened)
+            ds.append(defer.maybeDeferred(port.stopListening))
+        return defer.gatherResults(ds)
+
+
+class ProtocolTest(FakeServerTestCase):
+
+    @defer.inlineCallbacks
+    def test_put_get(self):
+        proto = yield self.connect()
+        yield proto.put('key', u'значение')
+        self.assertEqual((yield proto.get('key')), u'значение')
+        self.assertEqual((yield proto.vsiz('key')),
+                         len(u'значение'.encode('utf-8')))
+        yield self.assertFailure(proto.get('nope'), TyrantError)
+
+    @defer.inlineCallbacks
+    def test_pipelined_order(self):
+        proto = yield self.connect(pipeline_depth=3)
+        yield defer.gatherResults([proto.put('k%d' % i, 'v%d' % i)
+                                   for i in range(50)])
+        ds = [proto.get('k%d' % i) for i in range(50)]
+        self.assertEqual(proto.pending, 50)
+        values = yield defer.gatherResults(ds)
+        self.assertEqual(values, [u'v%d' % i for i in range(50)])
+
+    @defer.inlineCallbacks
+    def test_putnr_then_read(self):
+        proto = yield self.connect()
+        proto.putnr('key', 'value')
+        self.assertEqual((yield proto.get('key')), u'value')
+
+    @defer.inlineCallbacks
+    def test_bad_utf8_fails_its_command_only(self):
+        proto = yield self.connect()
+        yield proto.put('bin', '\xff\xfe')
+        yield proto.put('ok', 'value')
+        bad = proto.get('bin')
+        good = proto.get('ok')
+        size = proto.vsiz('ok')
+        yield self.assertFailure(bad, UnicodeDecodeError)
+        self.assertEqual((yield good), u'value')
+        self.assertEqual((yield size), 5)
+        self.assertEqual((yield proto.get('bin', literal=True)), '\xff\xfe')
+        self.assertIdentical(proto.lost_reason, None)
+
+    @defer.inlineCallbacks
+    def test_drained_while_paused(self):
+        proto = yield self.connect()
+        proto.write_high, proto.write_low = 1000, 400
+        proto.pauseProducing()
+        writes = [proto.putnr('k%d' % i, 'x' * 300) for i in range(4)]
+        self.assertEqual([d.called for d in writes],
+                         [True, True, True, False])
+        self.assertTrue(proto.queued_bytes >= proto.write_high)
+        proto.resumeProducing()
+        self.assertEqual(proto.queued_bytes, 0)
+        self.assertTrue(writes[-1].called)
+        self.assertEqual((yield proto.vsiz('k3')), 300)
+
+    @defer.inlineCallbacks
+    def test_drained_at_low_watermark(self):
+        proto = yield self.connect(pipeline_depth=1)
+        proto.write_high, proto.write_low = 1000, 400
+        puts = [proto.put('k%d' % i, 'x' * 300) for i in range(5)]
+        drained = proto.drained()
+        self.assertFalse(drained.called)
+        # Queued bytes when every put is done, and if drained had fired
+        seen = []
+        for d in puts:
+            d.addCallback(lambda ignored: seen.append(
+                (proto.queued_bytes > proto.write_low, drained.called)))
+        yield defer.gatherResults(puts)
+        self.assertEqual(seen, [(True, False), (True, False), (False, True),
+                                (False, True), (False, True)])
+
+    @defer.inlineCallbacks
+    def test_coalesced_lists_are_copied(self):
+        proto = yield self.connect()
+        yield proto.put('a', '1')
+        first = proto.fwmkeys('', 10)
+        second = proto.fwmkeys('', 10)
+        self.assertEqual(proto.pending, 1)
+        first, second = yield defer.gatherResults([first, second])
+        self.assertEqual(first, second)
+        self.assertNotIdentical(first, second)
+
+
+class ChunkedTest(FakeServerTestCase):
+
+    chunk_size = 1
+
+    @defer.inlineCallbacks
+    def test_chunked_replies(self):
+        proto = yield self.connect()
+        value = 'x' * 1000
+        yield proto.put('a', value)
+        yield proto.put('b', 'bb')
+        self.assertEqual((yield proto.get('a')), value)
+        self.assertEqual(sorted((yield proto.mget(['a', 'b']))),
+                         [('a', value), ('b', 'bb')])
+        self.assertEqual(sorted((yield proto.fwmkeys('', 10))), [u'a', u'b'])
+        self.assertEqual((yield proto.rnum()), 2)
+
+
+class CancelTest(FakeServerTestCase):
+
+    latency = 0.05
+
+    @defer.inlineCallbacks
+    def test_cancel_queued(self):
+        proto = yield self.connect(pipeline_depth=1)
+        yield proto.put('a', '1')
+        first = proto.get('a')
+        queued = proto.get('a', literal=True)
+        queued.cancel()
+        yield self.assertFailure(queued, defer.CancelledError)
+        self.assertEqual((yield first), u'1')
+        self.assertEqual((yield proto.get('a')), u'1')
+        self.assertIdentical(proto.lost_reason, None)
+
+    @defer.inlineCallbacks
+    def test_cancel_sent_poisons(self):
+        proto = yield self.connect()
+        sent = proto.get('a')
+        other = proto.vsiz('a')
+        sent.cancel()
+        yield self.assertFailure(sent, defer.CancelledError)
+        yield self.assertFailure(other, ConnectionPoisoned)
+        yield self.assertFailure(proto.get('a'), ConnectionPoisoned)
+
+    @defer.inlineCallbacks
+    def test_poisoned_connection_is_lost_once(self):
+        proto = yield self.connect()
+        sent = proto.get('a')
+        sent.cancel()
+        yield self.assertFailure(sent, defer.CancelledError)
+        self.assertFalse(proto.closed.called)
+        # Fired twice would raise AlreadyCalledError
+        yield proto.closed
+        self.assertTrue(proto.lost_reason.check(ConnectionPoisoned))
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        proto = yield self.connect(timeout=0.01)
+        yield self.assertFailure(proto.get('a'), defer.TimeoutError)
+        self.assertTrue(proto.lost_reason.check(ConnectionPoisoned))
+
+
+class BatchingTest(FakeServerTestCase):
+
+    @defer.inlineCallbacks
+    def test_passed_through_after_batch(self):
+        proto = BatchingProtocol((yield self.connect()))
+        put = proto.put('k', 'value')
+        size = proto.vsiz('k')
+        self.assertTrue((yield put))
+        self.assertEqual((yield size), 5)
+        self.assertEqual((yield proto.get('k')), u'value')
+
+    @defer.inlineCallbacks
+    def test_bad_utf8_fails_its_get_only(self):
+        proto = yield self.connect()
+        yield proto.put('a', '\xff')
+        yield proto.put('b', 'ok')
+        batching = BatchingProtocol(proto)
+        good = batching.get('b')
+        bad = batching.get('a')
+        raw = batching.get('a', literal=True)
+        self.assertEqual((yield good), u'ok')
+        yield self.assertFailure(bad, UnicodeDecodeError)
+        self.assertEqual((yield raw), '\xff')
+
+
+class CachingTest(FakeServerTestCase):
+
+    dbtype = 'table'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.backend = yield self.connect()
+        self.cache, self.queries = LRUCache(), LRUCache()
+        self.proto = CachingProtocol(self.backend, self.cache, self.queries)
+
+    @defer.inlineCallbacks
+    def test_hits_and_misses(self):
+        yield self.backend.put('k', 'v')
+        self.assertEqual((yield self.proto.get('k')), u'v')
+        self.assertEqual((yield self.proto.get('k')), u'v')
+        self.assertEqual((yield self.proto.get('k', literal=True)), 'v')
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    @defer.inlineCallbacks
+    def test_getlist_fetches_missing_keys_only(self):
+        yield self.backend.misc('putlist', ['a', '1', 'b', '2'])
+        yield self.proto.get('a')
+        fetched = []
+        misc = self.backend.misc
+        def spy(func, args, *rest):
+            fetched.append(list(args))
+            return misc(func, args, *rest)
+        self.patch(self.backend, 'misc', spy)
+        res = yield self.proto.misc('getlist', ['a', 'b', 'c'])
+        self.assertEqual(dict(zip(res[::2], res[1::2])),
+                         {u'a': u'1', u'b': u'2'})
+        self.assertEqual(fetched, [['b', 'c']])
+        res = yield self.proto.misc('getlist', ['b', 'a'])
+        self.assertEqual(fetched, [['b', 'c']])
+        self.assertEqual(sorted(res), [u'1', u'2', u'a', u'b'])
+
+    @defer.inlineCallbacks
+    def test_writes_invalidate(self):
+        yield self.backend.misc('putlist', ['a', '1', 'b', '1', 'c', '1'])
+        for key in 'abc':
+            yield self.proto.get(key)
+        yield self.proto.put('a', '2')
+        yield self.proto.misc('putlist', ['b', '2'])
+        yield self.proto.out('c')
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual((yield self.proto.get('a')), u'2')
+        self.assertEqual((yield self.proto.get('b')), u'2')
+        yield self.assertFailure(self.proto.get('c'), TyrantError)
+
+    @defer.inlineCallbacks
+    def test_fetch_racing_a_write_is_not_cached(self):
+        yield self.backend.put('k', 'old')
+        # Old value is read, its reply is held until the write is done
+        held = defer.Deferred()
+        get = self.backend.get
+        def held_get(key, literal=False):
+            d = get(key, literal)
+            return held.addCallback(lambda ignored: d)
+        self.patch(self.backend, 'get', held_get)
+        fetch = self.proto.get('k')
+        self.patch(self.backend, 'get', get)
+        yield self.proto.put('k', 'new')
+        held.callback(None)
+        self.assertEqual((yield fetch), u'old')
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual((yield self.proto.get('k')), u'new')
+
+    @defer.inlineCallbacks
+    def test_cached_search_results_are_copied(self):
+        yield self.backend.misc('put', ['k', 'name', 'x'])
+        first = yield self.proto.search([('name', 0, 'x')])
+        first.append(u'junk')
+        second = yield self.proto.search([('name', 0, 'x')])
+        third = yield self.proto.search([('name', 0, 'x')])
+        self.assertEqual(second, [u'k'])
+        self.assertNotIdentical(second, third)
+        self.assertEqual(self.queries.hits, 2)
+
+
+class KeyIteratorTest(FakeServerTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.proto = yield self.connect()
+        yield self.proto.misc('putlist', sum([['k%d' % i, 'v'] for i in
+                                              range(1000)], []))
+
+    @defer.inlineCallbacks
+    def test_walks_all_keys(self):
+        batches = []
+        count = yield KeyIterator(self.proto, batches.append, 100).start()
+        self.assertEqual(count, 1000)
+        self.assertEqual(map(len, batches), [100] * 10)
+        self.assertEqual(sorted(sum(batches, [])),
+                         sorted(u'k%d' % i for i in range(1000)))
+
+    @defer.inlineCallbacks
+    def test_consumer_raises(self):
+        def consumer(keys):
+            raise ValueError(keys[0])
+        d = KeyIterator(self.proto, consumer, 10, window=32).start()
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(self.proto.pending, 0)
+
+    @defer.inlineCallbacks
+    def test_consumer_fails_later(self):
+        def consumer(keys):
+            return task.deferLater(reactor, 0, self.fail, 'stop')
+        d = KeyIterator(self.proto, consumer, 10, window=32).start()
+        yield self.assertFailure(d, self.failureException)
+
+
+class PrefixScannerTest(FakeServerTestCase):
+
+    dbtype = 'B+ tree'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.proto = yield self.connect()
+        yield self.proto.misc('putlist', sum([[key, key.upper()] for key in
+            ('a', 'p0', 'p1', 'p2', 'p3', 'p4', 'p5', 'p6', 'q')], []))
+
+    @defer.inlineCallbacks
+    def test_ordered_pages(self):
+        pages = []
+        count = yield PrefixScanner(self.proto, 'p', pages.append, 3,
+                                    values=True).start()
+        self.assertEqual(count, 7)
+        self.assertEqual(map(len, pages), [3, 2, 2])
+        self.assertEqual(sum(pages, []), [(u'p%d' % i, u'P%d' % i)
+                                          for i in range(7)])
+
+    @defer.inlineCallbacks
+    def test_unordered_pages(self):
+        pages = []
+        count = yield PrefixScanner(self.proto, 'p', pages.append, 3,
+                                    values=True, ordered=False).start()
+        self.assertEqual(count, 7)
+        self.assertEqual(map(len, pages), [3, 3, 1])
+        self.assertEqual(sorted(sum(pages, [])), [(u'p%d' % i, u'P%d' % i)
+                                                  for i in range(7)])
+
+    @defer.inlineCallbacks
+    def test_consumer_deferred_pauses_scan(self):
+        sent = []
+        def consumer(page):
+            sent.append(self.proto.pending)
+            return task.deferLater(reactor, 0.01, lambda: None)
+        yield PrefixScanner(self.proto, 'p', consumer, 3).start()
+        # Only the next page is fetched while consumer works
+        self.assertEqual(sent, [1, 1, 1])
+
+
+class QueryTest(FakeServerTestCase):
+
+    dbtype = 'table'
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.db = yield Tyrant((yield self.connect())).ready
+        for i in range(5):
+            yield self.db.set('k%d' % i, {'name': 'n%d' % (i % 2),
+                                          'rank': str(i)})
+
+    @defer.inlineCallbacks
+    def test_count(self):
+        self.assertEqual((yield self.db.query.filter(name='n0').count()), 3)
+        self.assertEqual((yield self.db.query.filter(name='zz').count()), 0)
+
+    @defer.inlineCallbacks
+    def test_delete(self):
+        self.assertTrue((yield self.db.query.filter(name='n1').delete()))
+        self.assertEqual((yield self.db.count()), 3)
+        self.assertEqual((yield self.db.query.filter(name='n1').count()), 0)
+
+    @defer.inlineCallbacks
+    def test_values(self):
+        query = self.db.query.filter(name='n0').order('#rank')
+        res = yield query.values('rank')[:10]
+        self.assertEqual(res, [{u'k0': {u'rank': u'0'}},
+                               {u'k2': {u'rank': u'2'}},
+                               {u'k4': {u'rank': u'4'}}])
+        res = yield query.values()[1]
+        self.assertEqual(res, {u'k2': {u'name': u'n0', u'rank': u'2'}})
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_columns(self):
+        record = Record(u'name\x00боб\x00empty\x00\x00rank\x003'.encode(
+            'utf-8'))
+        self.assertEqual(len(record), 3)
+        self.assertEqual(record['name'], u'боб')
+        self.assertEqual(record[u'empty'], u'')
+        self.assertEqual(record.get('rank'), u'3')
+        self.assertEqual(record.get('nope', 0), 0)
+        self.assertRaises(KeyError, lambda: record['nope'])
+        self.assertIn('rank', record)
+        self.assertNotIn('ran', record)
+        self.assertEqual(record.keys(), [u'name', u'empty', u'rank'])
+        self.assertEqual(record, {u'name': u'боб', u'empty': u'',
+                                  u'rank': u'3'})
+
+    def test_literal_and_start(self):
+        raw = '\x00key\x00name\x00\xff'
+        record = Record(raw, literal=True, start=5)
+        self.assertEqual(record.items(), [('name', '\xff')])
+
+
+class CompactTest(FakeServerTestCase):
+
+    dbtype = 'table'
+
+    @defer.inlineCallbacks
+    def test_records(self):
+        db = yield Tyrant((yield self.connect()), compact=True).ready
+        yield db.set('k', {'name': u'боб', 'rank': '1'})
+        record = yield db['k']
+        self.assertIsInstance(record, Record)
+        self.assertEqual(record, {u'name': u'боб', u'rank': u'1'})
+        found = yield db.query.filter(rank='1').values('name')[0]
+        self.assertIsInstance(found[u'k'], Record)
+        self.assertEqual(found, {u'k': {u'name': u'боб'}})
+
+
+class BulkLoaderTest(FakeServerTestCase):
+
+    latency = 0.001
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.proto = yield self.connect()
+        self.batches = []
+        misc = self.proto.misc
+        def spy(func, args, *rest):
+            self.batches.append((len(args) // 2, self.proto.pending))
+            return misc(func, args, *rest)
+        self.patch(self.proto, 'misc', spy)
+
+    @defer.inlineCallbacks
+    def test_load(self):
+        reports = []
+        pairs = (('k%04d' % i, 'v') for i in xrange(2500))
+        stats = yield BulkLoader(self.proto, pairs, max_records=1000,
+                                 window=2, report=reports.append).start()
+        self.assertEqual(stats['records'], 2500)
+        self.assertEqual(stats['bytes'], 2500 * 6)
+        self.assertEqual(reports[-1], stats)
+        self.assertEqual([size for size, pending in self.batches],
+                         [1000, 1000, 500])
+        self.assertTrue(max(pending for size, pending in self.batches) < 2)
+        self.assertEqual(len(self.servers[0][0].db), 2500)
+
+    @defer.inlineCallbacks
+    def test_max_bytes(self):
+        pairs = [('k%d' % i, 'x' * 99) for i in range(10)]
+        yield BulkLoader(self.proto, pairs, max_bytes=250).start()
+        self.assertEqual([size for size, pending in self.batches],
+                         [3, 3, 3, 1])
+
+    @defer.inlineCallbacks
+    def test_failing_iterable(self):
+        def pairs():
+            for i in xrange(1500):
+                yield 'k%d' % i, 'v'
+            raise ValueError('bad row')
+        d = BulkLoader(self.proto, pairs(), max_records=1000).start()
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(self.proto.pending, 0)
+
+
+class MetricsTest(FakeServerTestCase):
+
+    @defer.inlineCallbacks
+    def test_collect(self):
+        proto = yield self.connect()
+        metrics = proto.metrics = MetricsCollector(task.Clock().seconds)
+        yield proto.put('k', 'value')
+        yield proto.putnr('n', 'value')
+        yield defer.gatherResults([proto.get('k'), proto.vsiz('k'),
+                                   proto.misc('getlist', ['k'])])
+        yield self.assertFailure(proto.get('nope'), TyrantError)
+        stats = metrics.stats()
+        commands = stats['commands']
+        self.assertEqual(sorted(commands), ['get', 'misc:getlist', 'put',
+                                            'putnr', 'vsiz'])
+        self.assertEqual(commands['get']['count'], 2)
+        self.assertEqual(commands['get']['errors'], {1: 1})
+        self.assertEqual(commands['put']['errors'], {})
+        self.assertEqual(commands['put']['bytes_sent'], 2 + 8 + 1 + 5)
+        self.assertEqual(commands['put']['p50_us'], 1)
+        self.assertEqual(stats['max_depth'], 2)
+        # Replies of put, get, vsiz, getlist and the failed get
+        self.assertEqual(stats['bytes_received'], 1 + 10 + 5 + 19 + 1)
+
+    @defer.inlineCallbacks
+    def test_failure_type(self):
+        proto = yield self.connect()
+        metrics = proto.metrics = MetricsCollector()
+        d = proto.get('k')
+        d.cancel()
+        yield self.assertFailure(d, defer.CancelledError)
+        self.assertEqual(metrics.stats()['commands']['get']['errors'],
+                         {'CancelledError': 1})
+
+    def test_percentile(self):
+        histogram = [0] * 64
+        histogram[3], histogram[10] = 98, 2
+        self.assertEqual(MetricsCollector.percentile(histogram, 0.5), 8)
+        self.assertEqual(MetricsCollector.percentile(histogram, 0.99), 1024)
+        self.assertIdentical(MetricsCollector.percentile([0] * 64, 0.5),
+                             None)
+
+
+class PoolTest(FakeServerTestCase):
+
+    latency = 0.01
+
+    def dead_port(self):
+        port = reactor.listenTCP(0, protocol.ServerFactory(),
+                                 interface='127.0.0.1')
+        number = port.getHost().port
+        return port.stopListening().addCallback(lambda ignored: number)
+
+    @defer.inlineCallbacks
+    def test_connect_spreads_commands(self):
+        pool = self.pool(size=3)
+        yield pool.connect()
+        self.assertEqual(len(pool.connections), 3)
+        ds = [pool.get('k%d' % i).addErrback(lambda reason: None)
+              for i in range(3)]
+        self.assertEqual([proto.pending for proto in pool.connections],
+                         [1, 1, 1])
+        yield defer.gatherResults(ds)
+
+    @defer.inlineCallbacks
+    def test_no_connection_times_out(self):
+        breaker = CircuitBreaker(threshold=2)
+        pool = self.pool((yield self.dead_port()), size=2, timeout=0.2,
+                         breaker=breaker)
+        ds = [pool.connect()] + [pool.get('k%d' % i) for i in range(5)]
+        results = yield defer.DeferredList(ds, consumeErrors=True)
+        for ok, reason in results:
+            self.assertFalse(ok)
+            reason.trap(CircuitOpen, defer.TimeoutError)
+        self.assertEqual(pool._waiting, [])
+        self.assertEqual(breaker.state, 'open')
+
+    @defer.inlineCallbacks
+    def test_disconnect_fails_waiting(self):
+        pool = self.pool((yield self.dead_port()), size=1)
+        pool.connect().addErrback(lambda reason: None)
+        d = pool.get('k')
+        pool.disconnect()
+        yield self.assertFailure(d, error.ConnectionDone)
+
+    @defer.inlineCallbacks
+    def test_write_ends_sharing_pool_wide(self):
+        pool = self.pool(size=2)
+        yield pool.connect()
+        yield pool.put('k', 'old')
+        first = pool.get('k')
+        write = pool.put('k', 'new')
+        second = pool.get('k')
+        self.assertEqual(pool.pending, 3)
+        yield defer.gatherResults([first, write, second])
+
+    @defer.inlineCallbacks
+    def test_iterkeys_before_connect(self):
+        pool = self.pool(size=2)
+        yield pool.connect()
+        yield pool.put('a', '1')
+        pool.disconnect()
+        del self.pools[:]
+
+        pool = self.pool(size=2)
+        keys = Tyrant(pool).keys()
+        yield pool.connect()
+        self.assertEqual((yield keys), [u'a'])
+
+
+class SearchTest(FakeServerTestCase):
+
+    dbtype = 'table'
+
+    @defer.inlineCallbacks
+    def fill(self, proto, rows):
+        for i in rows:
+            yield proto.misc('put', ['k%d' % i, 'name', 'n%d' % i,
+                                     'rank', str(i // 2)])
+
+    @defer.inlineCallbacks
+    def test_cursor_drops_added_order_column(self):
+        proto = yield self.connect()
+        yield self.fill(proto, range(7))
+        for columns, fields in ((['name'], 3), (['name', 'rank'], 5)):
+            records = []
+            cursor = SearchCursor(proto, [], records.extend, window=3,
+                                  order_type=proto.RDBQONUMDESC,
+                                  order_field='rank', columns=columns)
+            self.assertEqual((yield cursor.start()), 7)
+            self.assertEqual([record.split('\x00')[1] for record in records],
+                             [u'k%d' % i for i in (6, 5, 4, 3, 2, 1, 0)])
+            self.assertEqual(set(record.count('\x00') for record in records),
+                             set([fields]))
+
+    @defer.inlineCallbacks
+    def test_shards_drop_added_order_column(self):
+        protos = [(yield self.connect()), (yield self.connect(self.listen()))]
+        shards = TyrantShards(enumerate(protos))
+        for i in range(6):
+            yield shards.shard('k%d' % i).misc(
+                'put', ['k%d' % i, 'name', 'n%d' % i, 'rank', str(i)])
+        found = yield shards.search([], 4, 1, TyrantProtocol.RDBQONUMDESC,
+                                    'rank', columns=['name'])
+        self.assertEqual(found, [u'\x00k%d\x00name\x00n%d' % (i, i)
+                                 for i in (4, 3, 2, 1)])
+        found = yield shards.search([], 2, 0, TyrantProtocol.RDBQONUMDESC,
+                                    'rank', columns=['rank', 'name'])
+        self.assertEqual(found, [u'\x00k5\x00rank\x005\x00name\x00n5',
+                                 u'\x00k4\x00rank\x004\x00name\x00n4'])
+
+
+class CompiledQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(tx_tokyo, '_QUERIES', collections.OrderedDict())
+        self.patch(tx_tokyo, 'QUERY_CACHE_SIZE', 2)
+
+    def test_args(self):
+        query = CompiledQuery([('name', 0, 'x')], 0, 'rank', ['name'])
+        nargs, payload = query.args(5, 10)
+        self.assertEqual(nargs, 4)
+        self.assertIn('setlimit\x005\x0010', ''.join(payload))
+        nargs, payload = query.args(0)
+        self.assertEqual(nargs, 3)
+        self.assertNotIn('setlimit', ''.join(payload))
+
+    def test_shared(self):
+        first = compile_query([('name', 0, 'x')], columns=['name'])
+        self.assertIdentical(compile_query([('name', 0, 'x')],
+                                           columns=('name',)), first)
+        self.assertNotIdentical(compile_query([('name', 0, 'y')]), first)
+        self.assertNotIdentical(compile_query([('name', 0, 'x')]), first)
+
+    def test_least_recently_used_is_dropped(self):
+        a = compile_query([('a', 0, '1')])
+        b = compile_query([('b', 0, '1')])
+        self.assertIdentical(compile_query([('a', 0, '1')]), a)
+        compile_query([('c', 0, '1')])
+        self.assertEqual(len(tx_tokyo._QUERIES), 2)
+        self.assertIdentical(compile_query([('a', 0, '1')]), a)
+        self.assertNotIdentical(compile_query([('b', 0, '1')]), b)
+
+    def test_unhashable_is_not_shared(self):
+        conditions = [('a', 0, ['1', '2'])]
+        self.assertNotIdentical(compile_query(conditions),
+                                compile_query(conditions))
+        self.assertEqual(len(tx_tokyo._QUERIES), 0)
+
+
+class _Replica(object):
+
+    def __init__(self, rts):
+        self.rts = rts
+        self.pending = 0
+        self.searched = []
+
+    def stat(self):
+        return defer.succeed(u'rts\t%d\n' % (self.rts * 1e6))
+
+    def search_compiled(self, query, *args):
+        self.searched.append(query)
+        return defer.succeed([])
+
+    def search(self, *args):
+        self.searched.append(args)
+        return defer.succeed([])
+
+
+class ReplicasTest(unittest.TestCase):
+
+    def test_lag_against_freshest_replica(self):
+        clock = task.Clock()
+        clock.advance(100)
+        fresh, stale = _Replica(99), _Replica(90)
+        db = TyrantReplicas(_Replica(0), [fresh, stale], max_lag=5,
+                            clock=clock)
+        db.poll()
+        self.assertEqual(db.healthy(), [fresh])
+
+    def test_removing_search_goes_to_master(self):
+        clock = task.Clock()
+        clock.advance(100)
+        master, replica = _Replica(0), _Replica(100)
+        db = TyrantReplicas(master, [replica], clock=clock)
+        db.poll()
+        Query(db, 'table').filter(name='x')[:10]
+        self.assertEqual((len(master.searched), len(replica.searched)),
+                         (0, 1))
+        clock.advance(1)
+        Query(db, 'table').filter(name='x').delete()
+        db.search([('name', 0, 'x')], out=True)
+        self.assertEqual((len(master.searched), len(replica.searched)),
+                         (2, 1))
+        self.assertEqual(db.written, 101)
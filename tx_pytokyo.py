@@ -14,33 +14,43 @@ More information about Tokyo Cabinet:
 More information about Tokyo Tyrant: 
     http://tokyocabinet.sourceforge.net/tyrantdoc/
 
-This is an usage example:
-
-    >>> import pyrant
-    >>> t = pyrant.Tyrant(host='127.0.0.1', port=1978)
-    >>> if t.dbtype != pyrant.DBTYPETABLE:
-    ...     t['key'] = 'foo'
-    ...     print t['key']
+This is an usage example, Tyrant takes a connected TyrantProtocol or
+TyrantPool and its methods return deferreds:
+
+    >>> import tx_pytokyo
+    >>> from tx_tokyo import TyrantPool
+    >>> pool = TyrantPool('127.0.0.1', 1978)
+    >>> yield pool.connect()
+    >>> t = yield tx_pytokyo.Tyrant(pool).ready
+    >>> if t.dbtype != tx_pytokyo.DBTYPETABLE:
+    ...     yield t.set('key', 'foo')
+    ...     print (yield t['key'])
     ... else:
-    ...     t['key'] = {'name': 'foo'}
-    ...     print t['key']['name']
+    ...     yield t.set('key', {'name': 'foo'})
+    ...     print (yield t['key'])['name']
     foo
-    >>> del t['key']
-    >>> print t['key']
+    >>> yield pool.out('key')
+    True
+    >>> print (yield t['key'])
     Traceback (most recent call last):
         ...
     KeyError: 'key'
 
 """
 
+import array as _array
 import itertools as _itertools
-from protocol import TyrantProtocol, TyrantError
+
+from twisted.internet import defer
+
+from tx_tokyo import TyrantProtocol, TyrantError, DEFAULT_HOST, DEFAULT_PORT
+from tx_tokyo import ENCODING
+from tx_tokyo import CachingProtocol, KeyIterator, PrefixScanner
+from tx_tokyo import BulkLoader, SearchCursor, compile_query
 
 __version__ = '0.0.2'
 
 # Constants
-DEFAULT_HOST = '127.0.0.1'
-DEFAULT_PORT = 1978
 MAX_RESULTS = 1000
 
 # Table Types
@@ -50,8 +60,88 @@ DBTYPEMEMORY = 'on-memory hash'
 DBTYPEHASH = 'hash'
 
 
-def _parse_elem(elem, dbtype, sep=None):
+class Record(object):
+    """Read-only table record decoded lazily. Keeps the raw record and
+    offsets of its elements, a column is only decoded when it is read.
+    Columns are unicode unless literal is set. Elements before start
+    (e.g. the primary key of search records) are skipped.
+    """
+
+    __slots__ = ('_raw', '_index', '_literal')
+
+    def __init__(self, raw, literal=False, start=0):
+        # Start offset of every element, and the end of the last one
+        index = _array.array('I', [start])
+        find = raw.find
+        pos = find('\x00', start)
+        while pos != -1:
+            index.append(pos + 1)
+            pos = find('\x00', pos + 1)
+        index.append(len(raw) + 1)
+        self._raw = raw
+        self._index = index
+        self._literal = literal
+
+    def _elem(self, i):
+        elem = self._raw[self._index[i]:self._index[i + 1] - 1]
+        return elem if self._literal else elem.decode(ENCODING)
+
+    def _find(self, name):
+        if isinstance(name, unicode):
+            name = name.encode(ENCODING)
+        raw, index, size = self._raw, self._index, len(name)
+        for i in xrange(0, len(index) - 2, 2):
+            start = index[i]
+            if index[i + 1] - 1 - start == size and \
+                    raw.startswith(name, start):
+                return i + 1
+        return None
+
+    def __getitem__(self, name):
+        i = self._find(name)
+        if i is None:
+            raise KeyError(name)
+        return self._elem(i)
+
+    def get(self, name, default=None):
+        i = self._find(name)
+        return default if i is None else self._elem(i)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+        return (len(self._index) - 1) // 2
+
+    def __iter__(self):
+        return (self._elem(i) for i in xrange(0, len(self._index) - 2, 2))
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self._elem(i) for i in xrange(1, len(self._index) - 1, 2)]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def _parse_elem(elem, dbtype, sep=None, compact=False, literal=False):
     if dbtype == DBTYPETABLE:
+        if compact:
+            # elem is the raw record
+            return Record(elem, literal) if elem else None
         # Split element by \x00 which is the column separator
         elems = elem.split('\x00')
         if not elems[0]:
@@ -64,121 +154,159 @@ def _parse_elem(elem, dbtype, sep=None):
 
     return elem
 
-class Tyrant(TyrantProtocol):
-    """Main class of Tyrant implementation. 
+def _parse_records(records, compact=False, literal=False):
+    """Parse table records returned by search with columns, primary key is
+    in the column named ''. Returns a list of (key, columns dict), or of
+    (key, Record) for raw records if compact is set"""
+    res = []
+    for record in records:
+        if compact:
+            end = record.find('\x00', 1)
+            if end == -1:
+                end = len(record)
+            key = record[1:end]
+            if not literal:
+                key = key.decode(ENCODING)
+            res.append((key, Record(record, literal, end + 1)))
+            continue
+        elems = record.split('\x00')
+        cols = dict(_itertools.izip(elems[::2], elems[1::2]))
+        res.append((cols.pop('', None), cols))
+    return res
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode(ENCODING)
+    return str(value)
+
+
+def _key_error(failure, key):
+    failure.trap(TyrantError)
+    raise KeyError(key)
+
+
+def _default(failure, default):
+    failure.trap(KeyError)
+    return default
+
+
+class Tyrant(object):
+    """Main class of Tyrant implementation. It works on top of a connected
+    TyrantProtocol or TyrantPool, which is public as proto attribute.
+    All operations return deferreds.
     """
 
-    def __init__(self, separator=None, literal=False):
+    def __init__(self, proto, separator=None, literal=False, cache=None,
+                 query_cache=None, compact=False):
         """
+        proto: TyrantProtocol or TyrantPool instance to send commands with.
         separator: If this parameter is set, you can put and get lists as
         values.
         literal: If is set string is returned instead of unicode
+        cache: LRUCache instance to cache values read through this client.
+        Writes done through this client invalidate cached values.
+        query_cache: LRUCache instance to cache query results, can be shared
+        by clients. Writes done through this client clear it.
+        compact: If is set table records are returned as Record, decoded
+        lazily, instead of dicts.
         """
         # We want to make protocol public just in case anyone need any
         # specific option
+        if cache is not None or query_cache is not None:
+            proto = CachingProtocol(proto, cache, query_cache)
+        self.proto = proto
         self.separator = separator
         self.literal = literal
-        self._get_db_type()
+        self.compact = compact
+        self.dbtype = None
+        # Fired with self when database type is known
+        self.ready = self._get_db_type()
 
     @defer.inlineCallbacks
     def _get_db_type(self):
-        self.dbtype = yield self.get_stats()['type']
+        stats = yield self.get_stats()
+        self.dbtype = stats['type']
+        defer.returnValue(self)
 
     @defer.inlineCallbacks
-    def __contains__(self, key):
+    def has_key(self, key):
+        """Check if key exists in database"""
         try:
-            yield self.vsiz(key)
+            yield self.proto.vsiz(key)
         except TyrantError:
             defer.returnValue(False)
         else:
             defer.returnValue(True)
 
-    @defer.inlineCallbacks
     def __delitem__(self, key):
-        try:
-            res = yield self.out(key)
-            defer.returnValue(res)
-        except TyrantError:
-            raise KeyError(key)
+        return self.proto.out(key).addErrback(_key_error, key)
 
-    @defer.inlineCallbacks
     def __getitem__(self, key):
-        try:
-            return _parse_elem(self.get(key, self.literal), self.dbtype,
-                               self.separator)
-        except TyrantError:
-            raise KeyError(key)
+        compact = self.compact and self.dbtype == DBTYPETABLE
+        d = self.proto.get(key, self.literal or compact)
+        d.addCallback(_parse_elem, self.dbtype, self.separator, compact,
+                      self.literal)
+        return d.addErrback(_key_error, key)
 
-    @defer.inlineCallbacks
     def get(self, key, default=None):
         """Allow for getting with a default.
           
-           >>> t = Tyrant()
-           >>> t['foo'] = {'a': 'z', 'b': 'y'}
-           >>> print t.get('foo', {})
+           >>> t = Tyrant(proto)
+           >>> yield t.set('foo', {'a': 'z', 'b': 'y'})
+           >>> print (yield t.get('foo', {}))
            {u'a': u'z', u'b': u'y'}
-           >>> print t.get('bar', {})
+           >>> print (yield t.get('bar', {}))
            {}
 
         """
-        try:
-            return self[key]
-        except KeyError:
-            return default
+        return self[key].addErrback(_default, default)
 
-    @defer.inlineCallbacks
-    def __len__(self):
-        return self.rnum()
-
-    @defer.inlineCallbacks
-    def __repr__(self):
-        return object.__repr__(self)
+    def count(self):
+        """Get the number of records in database"""
+        return self.proto.rnum()
 
-    @defer.inlineCallbacks
     def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value):
+        """Store value for key. Dicts are stored as table records, lists
+        are joined with separator"""
         if isinstance(value, dict):
             flat = _itertools.chain([key], *value.iteritems())
-            self.misc('put', list(flat))
+            return self.proto.misc('put', list(flat))
             
         elif isinstance(value, (list, tuple)):
             assert self.separator, "Separator is not set"
 
             flat = self.separator.join(value)
-            self.put(key, flat)
+            return self.proto.put(key, flat)
 
         else:
-            self.put(key, value)
+            return self.proto.put(key, value)
 
-
-    @defer.inlineCallbacks
     def call_func(self, func, key, value, record_locking=False, 
                   global_locking=False):
         """Call specific function.
         """
         opts = ((record_locking and TyrantProtocol.RDBXOLCKREC) |
                 (global_locking and TyrantProtocol.RDBXOLCKGLB))
-        return self.ext(func, opts, key, value)
+        return self.proto.ext(func, opts, key, value)
 
-    @defer.inlineCallbacks
     def clear(self):
         """Used in order to remove all records of a remote database object"""
-        self.vanish()
+        return self.proto.vanish()
 
-    @defer.inlineCallbacks
     def concat(self, key, value, width=None):
         """Concatenate columns of the existing record"""
         if width is None:
-            self.putcat(key, value)
+            return self.proto.putcat(key, value)
         else:
-            self.putshl(key, value, width)
+            return self.proto.putshl(key, value, width)
 
-    @defer.inlineCallbacks
     def get_size(self, key):
         """Get the size of the value of a record"""
-        try:
-            return self.vsiz(key)
-        except TyrantError:
-            raise KeyError(key)
+        return self.proto.vsiz(key).addErrback(_key_error, key)
 
     @defer.inlineCallbacks
     def get_stats(self):
@@ -186,39 +314,44 @@ class Tyrant(TyrantProtocol):
         The return value is the status message of the database.The message 
         format is a dictionary. 
         """ 
-        stat = yield self.stat()
+        stat = yield self.proto.stat()
         defer.returnValue(dict(l.split('\t', 1) for l in stat.splitlines() if l))
 
-    @defer.inlineCallbacks
-    def iterkeys(self):
-        """Iterate keys using remote operations"""
-        self.iterinit()
-        try:
-            while True:
-                yield self.iternext()
-        except TyrantError:
-            pass
+    def iterkeys(self, consumer, batch_size=100, window=32):
+        """Iterate keys using remote operations. consumer is called with
+        lists of keys, it can return a deferred to pause iteration until it
+        is fired. Returns deferred fired with the number of keys.
+        See KeyIterator.
+        """
+        def start(proto):
+            if hasattr(proto, 'least_busy'):
+                # Iteration is bound to one connection of the pool
+                proto = proto.least_busy()
+            return KeyIterator(proto, consumer, batch_size, window).start()
+        if hasattr(self.proto, 'ready'):
+            # No connection of the pool may be usable yet
+            return self.proto.ready().addCallback(start)
+        return start(self.proto)
 
-    @defer.inlineCallbacks
     def keys(self):
         """Return the list of keys in database"""
-        return list(self.iterkeys())
+        keys = []
+        d = self.iterkeys(keys.extend)
+        return d.addCallback(lambda count: keys)
 
-    @defer.inlineCallbacks
     def update(self, other, **kwargs):
         """Update/Add given objects into database"""
-        self.multi_set(other.iteritems())
-        if kwargs:
-            self.update(kwargs)
+        items = dict(other)
+        items.update(kwargs)
+        return self.multi_set(items)
 
-    @defer.inlineCallbacks
     def multi_del(self, keys, no_update_log=False):
         """Remove given records from database"""
         opts = (no_update_log and TyrantProtocol.RDBMONOULOG or 0)
         if not isinstance(keys, (list, tuple)):
             keys = list(keys)
 
-        self.misc("outlist", keys, opts)
+        return self.proto.misc("outlist", keys, opts)
 
     @defer.inlineCallbacks
     def multi_get(self, keys, no_update_log=False):
@@ -227,20 +360,28 @@ class Tyrant(TyrantProtocol):
         if not isinstance(keys, (list, tuple)):
             keys = list(keys)
 
-        rval = self.misc("getlist", keys, opts)
+        compact = self.compact and self.dbtype == DBTYPETABLE
+        rval = yield self.proto.misc("getlist", keys, opts, compact)
         
         if len(rval) <= len(keys):
             # 1.1.10 protocol, may return invalid results
             if len(rval) < len(keys):
                 raise KeyError("Missing a result, unusable response in 1.1.10")
 
-            return rval
+            defer.returnValue(rval)
 
         # 1.1.11 protocol returns interleaved key, value list
+        if compact:
+            decode = (lambda key: key) if self.literal else \
+                (lambda key: key.decode(ENCODING))
+            defer.returnValue(dict(
+                (decode(rval[i]), _parse_elem(rval[i + 1], self.dbtype,
+                                              None, True, self.literal))
+                for i in xrange(0, len(rval), 2)))
         d = dict((rval[i], _parse_elem(rval[i + 1], self.dbtype, 
                                        self.separator)) \
                     for i in xrange(0, len(rval), 2))
-        return d
+        defer.returnValue(d)
 
     def multi_set(self, items, no_update_log=False):
         """Store given records into database"""
@@ -253,36 +394,82 @@ class Tyrant(TyrantProtocol):
                 v = self.separator.join(v)
             lst.extend((k, v))
 
-        return self.misc("putlist", lst, opts)
+        return self.proto.misc("putlist", lst, opts)
+
+    def bulk_load(self, items, max_records=1000, max_bytes=1024 * 1024,
+                  window=4, no_update_log=False, report=None,
+                  report_interval=1.0):
+        """Store records from a dict or any iterable of (key, value) pairs,
+        e.g. a generator, in batches of at most max_records records or
+        max_bytes, with up to window batches in flight. See BulkLoader.
+        report is called with loading stats (records/s and bytes/s among
+        them) every report_interval seconds. Returns deferred fired with
+        the final stats.
+
+        Example:
+            >>> stats = yield t.bulk_load(generate(), window=8)
+            >>> print stats['records_per_sec']
+
+        """
+        opts = (no_update_log and TyrantProtocol.RDBMONOULOG or 0)
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        return BulkLoader(self.proto, self._flatten(items), max_records,
+                          max_bytes, window, opts, report,
+                          report_interval).start()
+
+    def _flatten(self, items):
+        # Values as putlist stores them
+        for key, value in items:
+            if isinstance(value, dict):
+                value = '\x00'.join(_itertools.imap(
+                    _encode, _itertools.chain(*value.iteritems())))
+            elif isinstance(value, (list, tuple)):
+                assert self.separator, "Separator is not set"
+                value = self.separator.join(value)
+            yield key, value
 
-    @defer.inlineCallbacks
     def get_int(self, key):
         """Get an integer for given key. Must been added by addint"""
-        return self.getint(key)
+        return self.proto.getint(key)
     
-    @defer.inlineCallbacks
     def get_double(self, key):
         """Get a double for given key. Must been added by adddouble"""
-        return self.getdouble(key)
+        return self.proto.getdouble(key)
 
-    @defer.inlineCallbacks
     def prefix_keys(self, prefix, maxkeys=None):
         """Get forward matching keys in a database.
         The return value is a list object of the corresponding keys.
         """
         if maxkeys is None:
-            maxkeys = len(self)
+            # No limit
+            maxkeys = -1
 
-        return self.fwmkeys(prefix, maxkeys)
+        return self.proto.fwmkeys(prefix, maxkeys)
+
+    def scan_prefix(self, prefix, consumer, page_size=1000, values=False):
+        """Scan keys starting with prefix page by page, see PrefixScanner.
+        consumer is called with lists of keys, or of (key, value) pairs if
+        values is set, and can return a deferred to pause the scan.
+        Returns deferred fired with the number of scanned keys.
+        """
+        if values:
+            dbtype, separator = self.dbtype, self.separator
+            def parse(page):
+                return consumer([(k, _parse_elem(v, dbtype, separator))
+                                 for k, v in page])
+        else:
+            parse = consumer
+        return PrefixScanner(self.proto, prefix, parse, page_size, values,
+                             ordered=self.dbtype == DBTYPEBTREE,
+                             literal=self.literal).start()
 
-    @defer.inlineCallbacks
     def sync(self):
         """Synchronize updated content into database"""
-        self.sync()
+        return self.proto.sync()
 
-    @defer.inlineCallbacks
     def _get_query(self):
-        return Query(self, self.dbtype, self.literal)
+        return Query(self.proto, self.dbtype, self.literal, self.compact)
 
     query = property(_get_query)
 
@@ -292,17 +479,17 @@ class Q(object):
     but you cannot use operand "&", to do this just add more Q to your filter
     Example:
         
-        >>> t = Tyrant()
-        >>> t.clear()
-        >>> t.dbtype == pyrant.DBTYPETABLE
+        >>> t = yield Tyrant(proto).ready
+        >>> yield t.clear()
+        >>> t.dbtype == DBTYPETABLE
         True
-        >>> t['i'] = {'name': 'Reflejo', 'test': 0}
-        >>> t['you'] = {'name': 'Fulano', 'test': 1}
-        >>> res = t.query.filter(Q(name='Reflejo'), Q(test=0))
+        >>> yield t.set('i', {'name': 'Reflejo', 'test': 0})
+        >>> yield t.set('you', {'name': 'Fulano', 'test': 1})
+        >>> res = yield t.query.filter(Q(name='Reflejo'), Q(test=0))[:10]
         >>> res[0]['i']['name']
         u'Reflejo'
-        >>> res = t.query.filter(Q(name='Reflejo') | Q(name='Fulano'))
-        >>> len(res)
+        >>> q = t.query.filter(Q(name='Reflejo') | Q(name='Fulano'))
+        >>> yield q.count()
         2
 
     """
@@ -348,26 +535,29 @@ class Query(object):
     Usage:
 
     # Insert object into database
-    >>> t = Tyrant()
-    >>> t.dbtype == pyrant.DBTYPETABLE
+    >>> t = yield Tyrant(proto).ready
+    >>> t.dbtype == DBTYPETABLE
     True
-    >>> t['i'] = {'name': 'Reflejo', 'test': 0}
+    >>> yield t.set('i', {'name': 'Reflejo', 'test': 0})
 
-    # Now let's see if we can reach it querying tyrant
-    >>> res = t.query.filter(name='Reflejo', test=0).order('name')
-    >>> print res[0]['i']['name']
+    # Now let's see if we can reach it querying tyrant, indexing and
+    # slicing return deferreds
+    >>> res = yield t.query.filter(name='Reflejo', test=0).order('name')[0]
+    >>> print res['i']['name']
     Reflejo
 
     """
 
-    def __init__(self, proto, dbtype, literal=False):
+    def __init__(self, proto, dbtype, literal=False, compact=False):
         self._conditions = []
+        self._columns = []
         self._order = None
         self._order_t = 0
-        self._cache = {}
+        self._plan = None
         self._proto = proto
         self._dbtype = dbtype
         self.literal = literal
+        self.compact = compact
 
     def order(self, name):
         """Define result order. name parameter is the column name. 
@@ -391,8 +581,7 @@ class Query(object):
             order = (name, TyrantProtocol.RDBQOSTRASC)
 
         if self._order != order[0] or self._order_t != order[1]:
-            # Add another rule means that our naive cache should be empty'ed
-            self._cache = {}
+            self._plan = None
             self._order = order[0]
             self._order_t = order[1]
 
@@ -408,22 +597,22 @@ class Query(object):
             __ge: Greater or equal to expression
 
         Example:
-            >>> t = Tyrant()
-            >>> t.get_stats()['type']
+            >>> t = Tyrant(proto)
+            >>> (yield t.get_stats())['type']
             u'table'
-            >>> t['i'] = {'name': 'Reflejo', 'test': 4}
-            >>> t['i2'] = {'name': 'Reflejo', 'test': 4}
-            >>> t['i3'] = {'name': 'Reflejo', 'test': 4}
-
-            >>> res = t.query.filter(test__gt=0)[:1]
-            >>> len(res) == 1
-            True
-            >>> print res[0]['i']['name']
+            >>> yield t.clear()
+            >>> yield t.set('i', {'name': 'Reflejo', 'test': 4})
+            >>> yield t.set('i2', {'name': 'Reflejo', 'test': 4})
+            >>> yield t.set('i3', {'name': 'Reflejo', 'test': 4})
+
+            >>> yield t.query.filter(test__gt=0).count()
+            3
+            >>> res = yield t.query.filter(test__gt=0)[:1]
+            >>> print res[0].values()[0]['name']
             Reflejo
 
         """
-        # Add another rule means that our naive cache should be empty'ed
-        self._cache = {}
+        self._plan = None
 
         # Iterate arguments. Should be instances of Q
         for q in args:
@@ -436,12 +625,62 @@ class Query(object):
 
         return self
 
-    def __len__(self):
-        return len(self[:])
+    def values(self, *columns):
+        """Get only given columns of found records. Projection is done by
+        server, so other columns are never sent.
+
+        Example:
+            >>> res = yield t.query.filter(test__gt=0).values('name')[:10]
+
+        """
+        self._plan = None
+        self._columns = list(columns)
+        return self
+
+    def count(self):
+        """Count found records on server side. Returns deferred"""
+        plan = compile_query(self._get_conditions(), count=True)
+        d = self._proto.search_compiled(plan, 0, 0)
+        return d.addCallback(lambda res: int(res[0]) if res else 0)
+
+    def delete(self):
+        """Remove found records on server side. Returns deferred"""
+        plan = compile_query(self._get_conditions(), out=True)
+        d = self._proto.search_compiled(plan, 0, 0)
+        return d.addCallback(lambda res: True)
+
+    def stream(self, consumer, window=100):
+        """Stream all found records window by window, see SearchCursor.
+        consumer is called with lists of {key: columns} dicts, and can
+        return a deferred to pause streaming. Windows ordered by a number
+        column, e.g. order('#ranking'), cost the same however deep they
+        are. Returns deferred fired with the number of records.
+
+        Example:
+            >>> n = yield t.query.order('#ranking').stream(process, 500)
+
+        """
+        compact, literal = self.compact, self.literal
+        def parse(records):
+            return consumer([{key: cols} for key, cols
+                             in _parse_records(records, compact, literal)])
+        return SearchCursor(self._proto, self._get_conditions(), parse,
+                            window, self._order_t, self._order, self._columns,
+                            literal or compact).start()
+
+    def _get_conditions(self):
+        return [(c.name, c.op, c.expr) for c in self._conditions]
+
+    def _get_plan(self):
+        # Compiled once per query, only limit and offset change in slices
+        if self._plan is None:
+            self._plan = compile_query(self._get_conditions(), self._order_t,
+                                       self._order, self._columns)
+        return self._plan
 
     def __repr__(self):
-        # Do the query using getitem
-        return str(self[:])
+        return "<Query %r order %s %s>" % (self._conditions, self._order,
+                                           self._order_t)
 
     def __getitem__(self, k):
         # Retrieve an item or slice from the set of results.
@@ -461,27 +700,15 @@ class Query(object):
             offset = k
             limit = 1
 
-        cache_key = "%s_%s" % (offset, limit)
-        if cache_key in self._cache:
-            return self._cache[cache_key]
-
-        conditions = [(c.name, c.op, c.expr) for c in self._conditions]
-
-        # Do the search.
-        keys = self._proto.search(conditions, limit, offset,
-                                  order_type=self._order_t,
-                                  order_field=self._order)
-
-        # Since results are keys, we need to query for actual values
-        if isinstance(k, slice):
-            ret = [{key: _parse_elem(self._proto.get(key, self.literal),
-                                     self._dbtype)} \
-                        for key in keys]
-        else:
-            ret = {
-                keys[0]: _parse_elem(self._proto.get(keys[0], self.literal), 
-                                     self._dbtype)
-            }
+        # Do the search, records come in the same reply
+        d = self._proto.search_compiled(self._get_plan(), limit, offset,
+                                        literal=self.literal or self.compact)
+        d.addCallback(self._got_records, isinstance(k, slice))
+        return d
 
-        self._cache[cache_key] = ret
+    def _got_records(self, records, is_slice):
+        ret = [{key: cols} for key, cols
+               in _parse_records(records, self.compact, self.literal)]
+        if not is_slice:
+            ret = ret[0]
         return ret
@@ -7,20 +7,46 @@ Protocol implementation for Tyrant
 tx version coded by Mikhail Krivushin aka Deepwalker
 """
 
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
 import math
 import socket
 import struct
+import timeit
 
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.python import failure
 
 class TyrantError(Exception):
     """
     Tyrant error, socket and communication errors are not included here.
     """
 
+class ConnectionPoisoned(Exception):
+    """
+    Connection was torn down because a command sent on it was cancelled
+    (e.g. its deadline passed), the rest of its replies can't be trusted.
+    """
+
+class CircuitOpen(Exception):
+    """
+    Server is considered unhealthy, command was not sent.
+    """
+
 # pyrant constants
 MAGIC_NUMBER = 0xc8
 ENCODING = 'UTF-8'
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 1978
+
+# Wire formats
+_INT = struct.Struct('>I')
+_LONG = struct.Struct('>Q')
+_DOUBLE = struct.Struct('>QQ')
+_PAIR = struct.Struct('>II')
 
 
 def _ulen(expr):
@@ -28,32 +54,305 @@ def _ulen(expr):
             if isinstance(expr, unicode) else len(expr)
 
 
-def _pack(code, *args):
-    # Craft string that we'll use to send data based on args type and content
-    buf = ''
+# Precompiled request headers by struct format
+_HEADERS = {}
+
+
+def _header(fmt):
+    header = _HEADERS.get(fmt)
+    if header is None:
+        header = _HEADERS[fmt] = struct.Struct(fmt)
+    return header
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode(ENCODING)
+    return str(value)
+
+
+def _pack_list(values, parts):
+    """Append length prefixed values to parts"""
+    values = [v if v.__class__ is str else _bytes(v) for v in values]
+    chunk = [None] * (2 * len(values))
+    chunk[::2] = map(_INT.pack, map(len, values))
+    chunk[1::2] = values
+    parts.extend(chunk)
+
+
+def _pack_parts(code, *args):
+    # Craft strings that we'll send based on args type and content, header
+    # comes first and then payload parts, values are never copied
     fmt = '>BB'
-    largs = []
+    largs = [MAGIC_NUMBER, code]
+    parts = ['']
     for arg in args:
-        if isinstance(arg, int):
-            fmt += 'I'
+        # Exact types are checked first as the most common case
+        cls = arg.__class__
+        if cls is str:
+            parts.append(arg)
+
+        elif cls is int:
+            # Negative numbers are sent as signed, e.g. -1 for no limit
+            fmt += 'I' if arg >= 0 else 'i'
             largs.append(arg)
 
         elif isinstance(arg, str):
-            buf += arg
+            parts.append(arg)
+
+        elif isinstance(arg, int):
+            fmt += 'I' if arg >= 0 else 'i'
+            largs.append(arg)
 
         elif isinstance(arg, unicode):
-            buf += arg.encode(ENCODING)
+            parts.append(arg.encode(ENCODING))
         
         elif isinstance(arg, long):
             fmt += 'Q'
             largs.append(arg)
 
         elif isinstance(arg, (list, tuple)):
-            for v in arg:
-                v = str(v)
-                buf += "%s%s" % (struct.pack(">I", len(v)), v)
+            _pack_list(arg, parts)
+
+    header = _HEADERS.get(fmt) or _header(fmt)
+    parts[0] = header.pack(*largs)
+    return parts
+
+
+def _pack(code, *args):
+    return ''.join(_pack_parts(code, *args))
+
+
+class RecvBuffer(object):
+    """Receive buffer for the protocol. Incoming chunks are appended to one
+    bytearray and consumed through a read offset, so every received byte is
+    copied once on the way in and once on the way out, whatever the size of
+    the reply. Consumed space is given back when it outgrows the unread data.
+    """
+
+    # Don't bother compacting less than this
+    COMPACT_THRESHOLD = 64 * 1024
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._buf) - self._pos
+
+    def feed(self, data):
+        """Append received data to the buffer"""
+        if not self._pos and not self._buf:
+            self._buf = bytearray(data)
+        else:
+            self._buf += data
+
+    def read(self, bytes):
+        """Consume given bytes from buffer and return them as a string"""
+        pos = self._pos
+        end = pos + bytes
+        res = memoryview(self._buf)[pos:end].tobytes()
+        self._pos = end
+        self._compact()
+        return res
+
+    def read_byte(self):
+        """Read one unsigned byte, None if it has not arrived yet"""
+        if self._pos < len(self._buf):
+            res = self._buf[self._pos]
+            self._pos += 1
+            self._compact()
+            return res
+
+    def read_int(self):
+        """Read an integer (4 bytes), None if it has not arrived yet"""
+        if len(self) >= 4:
+            return self.unpack(_INT)[0]
+
+    def read_long(self):
+        """Read a long (8 bytes), None if it has not arrived yet"""
+        if len(self) >= 8:
+            return self.unpack(_LONG)[0]
+
+    def read_double(self):
+        """Read 2 long numbers (16 bytes) as a float, None if they have not
+        arrived yet"""
+        if len(self) >= 16:
+            intpart, fracpart = self.unpack(_DOUBLE)
+            return intpart + (fracpart * 1e-12)
+
+    def read_str(self):
+        """Read a string (n bytes, which is an integer just before string).
+        Nothing is consumed until the whole string has arrived"""
+        avail = len(self) - 4
+        if avail >= 0:
+            size = _INT.unpack_from(self._buf, self._pos)[0]
+            if size <= avail:
+                self._pos += 4
+                return self.read(size)
+
+    def read_unicode(self):
+        """Read a string and decode it"""
+        res = self.read_str()
+        if res is not None:
+            return res.decode(ENCODING)
+
+    def read_strpair(self):
+        """Read string pair (n bytes, n bytes which are 2 integers just
+        before pair). Nothing is consumed until the whole pair has arrived"""
+        avail = len(self) - 8
+        if avail >= 0:
+            klen, vlen = _PAIR.unpack_from(self._buf, self._pos)
+            if klen + vlen <= avail:
+                self._pos += 8
+                return self.read(klen), self.read(vlen)
+
+    def unpack(self, fmt):
+        """Consume and unpack a precompiled struct.Struct from the buffer"""
+        res = fmt.unpack_from(self._buf, self._pos)
+        self._pos += fmt.size
+        self._compact()
+        return res
+
+    def _compact(self):
+        pos = self._pos
+        if pos == len(self._buf):
+            # Everything is consumed, just drop it
+            self._buf = bytearray()
+            self._pos = 0
+        elif pos >= self.COMPACT_THRESHOLD and pos * 2 >= len(self._buf):
+            del self._buf[:pos]
+            self._pos = 0
+
+class Reply(object):
+    """Reply decoder for a command which answers with a status byte only.
+    Every sent command puts its reply in recv_fifo, the reply consumes the
+    whole server response from the receive buffer in one pass as data comes
+    in and then fires its deferred once with the decoded result.
+    """
+
+    # Whether the server sends the body of reply even on failure
+    body_on_error = False
+
+    # Protocol the command was sent with
+    proto = None
+
+    def __init__(self):
+        self.deferred = defer.Deferred(self._cancel)
+        self.code = None
+
+    def _cancel(self, deferred):
+        if self.proto is not None:
+            self.proto._cancel(self)
+
+    def decode(self, buf):
+        """Consume available reply data from buf. Returns True when whole
+        reply is read and it is time to fire()"""
+        if self.code is None:
+            self.code = buf.read_byte()
+            if self.code is None:
+                return False
+        if self.code and not self.body_on_error:
+            return True
+        return self.decode_body(buf)
+
+    def decode_body(self, buf):
+        return True
+
+    def result(self):
+        return True
+
+    def signature(self):
+        """Replies with the same signature decode the same way"""
+        return (self.__class__,)
+
+    def fire(self):
+        if self.code:
+            self.deferred.errback(TyrantError(self.code))
+            return
+        try:
+            result = self.result()
+        except Exception:
+            # Bad value (e.g. not UTF-8) fails this reply only, the stream
+            # itself is fine
+            self.deferred.errback()
+        else:
+            self.deferred.callback(result)
+
+
+class FieldReply(Reply):
+    """Reply with a single field after status byte. read is a RecvBuffer
+    field reader, convert is applied to the field value if given"""
+
+    def __init__(self, read, convert=None):
+        Reply.__init__(self)
+        self.read = read
+        self.convert = convert
+        self.value = None
+
+    def decode_body(self, buf):
+        self.value = self.read(buf)
+        return self.value is not None
+
+    def result(self):
+        if self.convert is not None:
+            return self.convert(self.value)
+        return self.value
+
+    def signature(self):
+        return (self.__class__, self.read, self.convert)
+
+
+class ListReply(Reply):
+    """Reply with the number of records after status byte followed by the
+    records, each one read by RecvBuffer field reader read, convert is
+    applied to every record if given"""
+
+    def __init__(self, read, body_on_error=False, convert=None):
+        Reply.__init__(self)
+        self.read = read
+        self.body_on_error = body_on_error
+        self.convert = convert
+        self.count = None
+        self.records = []
+
+    def decode_body(self, buf):
+        if self.count is None:
+            self.count = buf.read_int()
+            if self.count is None:
+                return False
+        read = self.read
+        records = self.records
+        append = records.append
+        for i in xrange(self.count - len(records)):
+            rec = read(buf)
+            if rec is None:
+                return False
+            append(rec)
+        return True
+
+    def result(self):
+        if self.convert is not None:
+            return map(self.convert, self.records)
+        return self.records
+
+    def signature(self):
+        return (self.__class__, self.read, self.body_on_error, self.convert)
+
+
+def _decode(val):
+    # Values are decoded when the reply fires, not while it is parsed
+    return val.decode(ENCODING)
+
+
+def _unpack_int(val):
+    return struct.unpack('I', val)[0]
+
+
+def _unpack_double(val):
+    intpart, fracpart = struct.unpack('>QQ', val)
+    return intpart + (fracpart * 1e-12)
 
-    return "%s%s" % (struct.pack(fmt, MAGIC_NUMBER, code, *largs), buf)
 
 # Здесь будет город-сад, точнее twisted протокол.
 class TyrantProtocol(protocol.Protocol):
@@ -137,99 +436,258 @@ class TyrantProtocol(protocol.Protocol):
         'seq_or': RDBQCSTROREQ,
         'neq_or': RDBQCNUMOREQ
     }
-    ########
-    def __init__(self):
-        self.bufer = ''
-        self.recv_fifo=[]
-
-    def dataReceived(self, data):
-        #print "Data recieved", repr(data)
-        self.bufer+=data
-        while self.recv_fifo:
-            d,bytes=self.recv_fifo[0]
-            if bytes <= len(self.bufer):
-                res = self.bufer[:bytes]
-                self.bufer = self.bufer[bytes:]
-                self.recv_fifo.pop(0)
-                d.callback(res)
-            else:
-                break
-
-    @defer.inlineCallbacks
-    def sock_send(self, *args,**kwargs):
-        """Pack arguments and send the buffer to the socket"""
-        #print "Посылка -", args, kwargs
-        sync = kwargs.pop('sync', True)
-        # Send message to socket, then check for errors as needed.
-        self.transport.write(_pack(*args))
+    # Maximum number of commands sent to the server and waiting for reply.
+    # Commands above it wait in send_queue and are sent in order as replies
+    # arrive, None means no limit and 1 means strict request/response mode.
+    pipeline_depth = None
 
-        #fail_code = yield self.get_byte()
-        fail_code = yield self.recv(1)
-        fail_code = ord(fail_code)
-        if fail_code:
-            raise TyrantError(fail_code)
-        defer.returnValue(True)
+    # Identical read commands in flight share one request and its result
+    coalesce = True
 
-    @defer.inlineCallbacks
-    def recv(self, bytes):
-        """Get given bytes from socket"""
-        #print "Try to get bytes",bytes,repr(self.bufer)
-        if bytes < len(self.bufer):
-            res = self.bufer[:bytes]
-            self.bufer = self.bufer[bytes:]
-            defer.returnValue(res)
-        else:
-            d = defer.Deferred()
-            self.recv_fifo.append((d,bytes))
-            #print self.recv_fifo
-            res = yield d
-            defer.returnValue(res)
-
-    def get_byte(self):
-        """Get 1 byte from socket."""
-        return self.recv(1)
+    # Requests of a few parts with at least this size are handed to
+    # transport.writeSequence instead of being joined here. The transport
+    # still joins its buffer before sending, so this only saves the copy
+    # made when other writes are already buffered (see bench_tx_tokyo.py)
+    scatter_size = 64 * 1024
 
-    @defer.inlineCallbacks
-    def get_int(self):
-        """Get an integer (4 bytes) from socket."""
-        res = yield self.recv(4)
-        defer.returnValue(struct.unpack('>I', res)[0])
+    # Commands wait in send_queue while the transport has asked to pause
+    # writing. No-reply writes are delayed when queued bytes reach
+    # write_high, until they drop to write_low.
+    write_high = 1024 * 1024
+    write_low = 256 * 1024
 
-    @defer.inlineCallbacks
-    def get_long(self):
-        """Get a long (8 bytes) from socket."""
-        res = yield self.recv(8)
-        defer.returnValue(struct.unpack('>Q', res)[0])
+    # Default deadline of commands in seconds, None means no deadline
+    timeout = None
+    clock = reactor
 
-    @defer.inlineCallbacks
-    def get_str(self):
-        """Get a string (n bytes, which is an integer just before string)."""
-        data_len = yield self.get_int()
-        string = yield self.recv(data_len)
-        defer.returnValue(string)
+    # Metrics hooks, see Metrics
+    metrics = None
 
-    @defer.inlineCallbacks
-    def get_unicode(self):
-        """Get a unicode."""
-        string = yield self.get_str()
-        defer.returnValue(string.decode(ENCODING))
+    # Misc functions which only read
+    READ_MISC = ('getlist', 'search')
 
-    @defer.inlineCallbacks
-    def get_double(self):
-        """Get 2 long numbers (16 bytes) from socket"""
-        data = yield self.recv(16)
-        intpart, fracpart = struct.unpack('>QQ', data)
-        defer.returnValue(intpart + (fracpart * 1e-12))
+    ########
+    def __init__(self, pipeline_depth=None, timeout=None):
+        self.bufer = RecvBuffer()
+        self.recv_fifo = collections.deque()
+        self.send_queue = collections.deque()
+        self.inflight = {}
+        self.lost_reason = None
+        self.paused = False
+        self.queued_bytes = 0
+        self._drain_waiters = []
+        if pipeline_depth is not None:
+            self.pipeline_depth = pipeline_depth
+        if timeout is not None:
+            self.timeout = timeout
+
+    @property
+    def pending(self):
+        """Number of commands waiting for their reply"""
+        return len(self.recv_fifo) + len(self.send_queue)
 
-    @defer.inlineCallbacks
-    def get_strpair(self):
-        """Get string pair (n bytes, n bytes which are 2 integers just 
-        before pair)"""
-        klen = yield self.get_int()
-        vlen = yield self.get_int()
-        kstr = yield self.recv(klen)
-        vstr = yield self.recv(vlen)
-        defer.returnValue(kstr,vstr)
+    def dataReceived(self, data):
+        #print "Data recieved", repr(data)
+        if self.metrics is not None:
+            self.metrics.received(self, len(data))
+        if self.lost_reason is not None:
+            # Poisoned, nothing is expected any more
+            return
+        buf = self.bufer
+        buf.feed(data)
+        fifo = self.recv_fifo
+        while fifo and fifo[0].decode(buf):
+            reply = fifo.popleft()
+            if self.send_queue:
+                self._send_queued()
+            reply.fire()
+
+    def connectionMade(self):
+        # Transport pauses us when its write buffer is full
+        self.transport.registerProducer(self, True)
+        # Send commands issued before connection was made
+        self._send_queued()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self._fail_pending(reason)
+
+    def _fail_pending(self, reason):
+        # Connection is not usable any more, fail everything waiting on it
+        if self.lost_reason is None:
+            self.lost_reason = reason
+        pending = list(self.recv_fifo)
+        pending.extend(reply for reply, parts in self.send_queue
+                       if reply is not None)
+        self.recv_fifo.clear()
+        self.send_queue.clear()
+        self.queued_bytes = 0
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for reply in pending:
+            reply.deferred.errback(reason)
+        for d in waiters:
+            d.errback(reason)
+
+    def poison(self):
+        """Fail all pending commands and abort the connection, it can't be
+        used any more"""
+        if self.lost_reason is not None:
+            return
+        self._fail_pending(failure.Failure(ConnectionPoisoned()))
+        if self.transport is not None:
+            self.transport.abortConnection()
+
+    def _cancel(self, reply):
+        # Commands not sent yet are just forgotten
+        for i, (queued, parts) in enumerate(self.send_queue):
+            if queued is reply:
+                del self.send_queue[i]
+                self.queued_bytes -= sum(map(len, parts))
+                self._send_queued()
+                return
+        # Reply of a sent command is on its way, the stream is out of sync
+        # if it is skipped, and the server may be stalled
+        try:
+            self.recv_fifo.remove(reply)
+        except ValueError:
+            return
+        self.poison()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._send_queued()
+
+    def stopProducing(self):
+        pass
+
+    def sock_send(self, *args, **kwargs):
+        """Pack arguments and send the buffer to the socket. Returns deferred
+        of reply given by reply keyword, status only reply by default.
+
+        Replies are decoded strictly in the order commands were sent, so any
+        number of commands can be in flight on one connection.
+
+        Commands sent with shared keyword only read, when coalesce is on,
+        identical ones in flight share a single request: later callers get
+        the result of the first one, lists are copied for every caller. Any
+        other command ends sharing, so reads sent after a write never get
+        older results. Connections of a TyrantPool share in-flight reads, a
+        write on any of them ends sharing on all.
+
+        Commands can be cancelled with their deferreds, one not sent yet is
+        dropped, cancelling a sent one poisons the connection (see
+        poison()). If timeout is set commands are cancelled with
+        defer.TimeoutError after timeout seconds, a deadline for any one
+        command is set with addTimeout() of its deferred.
+
+        Commands sent with noreply keyword get no reply from the server,
+        they are written and forgotten. Returned deferred fires when more
+        can be written, see write_high.
+        """
+        #print "Посылка -", args, kwargs
+        sync = kwargs.pop('sync', True)
+        if kwargs.pop('noreply', False):
+            if self.lost_reason is not None:
+                return defer.fail(self.lost_reason)
+            if self.inflight:
+                self.inflight.clear()
+            parts = _pack_parts(*args)
+            if self.metrics is not None:
+                self.metrics.done(self.metrics.sent(
+                    self, _command_name(args), sum(map(len, parts)),
+                    len(self.recv_fifo)), None)
+            self._send(None, parts)
+            return self.drained()
+
+        reply = kwargs.pop('reply', None) or Reply()
+        shared = kwargs.pop('shared', False)
+        if self.lost_reason is not None:
+            reply.deferred.errback(self.lost_reason)
+            return reply.deferred
+
+        parts = _pack_parts(*args)
+        shared = shared and self.coalesce
+        if shared:
+            key = (''.join(parts),) + reply.signature()
+            waiters = self.inflight.get(key)
+            if waiters is not None:
+                d = defer.Deferred()
+                waiters.append(d)
+                return d
+        elif self.inflight:
+            self.inflight.clear()
+
+        reply.proto = self
+        if self.timeout is not None:
+            reply.deferred.addTimeout(self.timeout, self.clock)
+        if self.metrics is not None:
+            context = self.metrics.sent(self, _command_name(args),
+                                        sum(map(len, parts)),
+                                        len(self.recv_fifo))
+            reply.deferred.addBoth(_measured, self.metrics, context)
+        if shared:
+            waiters = self.inflight[key] = []
+            reply.deferred.addBoth(self._shared_done, key, waiters)
+
+        self._send(reply, parts)
+        return reply.deferred
+
+    def drained(self):
+        """Deferred fired when queued bytes are below write_high, or after
+        they drop to write_low"""
+        if self.queued_bytes < self.write_high:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+        return d
+
+    def _send(self, reply, parts):
+        # reply is None for commands without reply
+        depth = self.pipeline_depth
+        if self.send_queue or self.paused or not self.connected or \
+                (reply is not None and depth is not None and
+                 len(self.recv_fifo) >= depth):
+            self.send_queue.append((reply, parts))
+            self.queued_bytes += sum(map(len, parts))
+        else:
+            if reply is not None:
+                # Reply must be queued before anything is written
+                self.recv_fifo.append(reply)
+            self._write(parts)
+
+    def _write(self, parts):
+        # Twisted concatenates pending writes in doWrite, a joined request
+        # would be copied once more there when it is not alone in the buffer
+        if len(parts) <= 4 and sum(map(len, parts)) >= self.scatter_size:
+            self.transport.writeSequence(parts)
+        else:
+            self.transport.write(''.join(parts))
+
+    def _shared_done(self, result, key, waiters):
+        if self.inflight.get(key) is waiters:
+            del self.inflight[key]
+        for d in waiters:
+            # Every caller gets its own list
+            d.callback(list(result) if isinstance(result, list) else result)
+        return result
+
+    def _send_queued(self):
+        depth = self.pipeline_depth
+        fifo = self.recv_fifo
+        queue = self.send_queue
+        while queue and not self.paused and (
+                depth is None or len(fifo) < depth or queue[0][0] is None):
+            reply, parts = queue.popleft()
+            self.queued_bytes -= sum(map(len, parts))
+            if reply is not None:
+                fifo.append(reply)
+            self._write(parts)
+        if self._drain_waiters and self.queued_bytes <= self.write_low:
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for d in waiters:
+                d.callback(None)
     ########
 
     def put(self, key, value):
@@ -257,113 +715,94 @@ class TyrantProtocol(protocol.Protocol):
         return self.sock_send(self.PUTSHL, _ulen(key), _ulen(value), width, key, value)
 
     def putnr(self, key, value):
-        """Set key to value without waiting for a server response
+        """Set key to value without waiting for a server response, which
+        never comes. Returned deferred fires when more can be written
         """
-        return self.sock_send(self.PUTNR, _ulen(key), _ulen(value), key, value)
+        return self.sock_send(self.PUTNR, _ulen(key), _ulen(value), key, value,
+                              noreply=True)
 
     def out(self, key):
         """Remove key from server
         """
         return self.sock_send(self.OUT, _ulen(key), key)
 
-    @defer.inlineCallbacks
     def get(self, key, literal=False):
         """Get the value of a key from the server
         """
-        yield self.sock_send(self.GET, _ulen(key), key)
-        if literal:
-            data = yield self.get_str()
-        else:
-            data = yield self.get_unicode()
-        defer.returnValue(data)
+        convert = None if literal else _decode
+        return self.sock_send(self.GET, _ulen(key), key,
+                              reply=FieldReply(RecvBuffer.read_str, convert),
+                              shared=True)
 
-    @defer.inlineCallbacks
     def getint(self, key):
         """Get an integer for given key. Must been added by addint"""
-        yield self.sock_send(self.GET, _ulen(key), key)
-        val = yield self.get_str()
-        defer.returnValue(struct.unpack('I', val)[0])
+        return self.sock_send(self.GET, _ulen(key), key,
+                    reply=FieldReply(RecvBuffer.read_str, _unpack_int),
+                    shared=True)
 
-    @defer.inlineCallbacks
     def getdouble(self, key):
         """Get a double for given key. Must been added by adddouble"""
-        yield self.sock_send(self.GET, _ulen(key), key)
-        val = yield self.get_str()
-        intpart, fracpart = struct.unpack('>QQ', val)
-        defer.returnValue(intpart + (fracpart * 1e-12))
+        return self.sock_send(self.GET, _ulen(key), key,
+                    reply=FieldReply(RecvBuffer.read_str, _unpack_double),
+                    shared=True)
 
-    @defer.inlineCallbacks
     def mget(self, klst):
         """Get key,value pairs from the server for the given list of keys
         """
-        yield self.sock_send(self.MGET, len(klst), klst)
-        numrecs = yield self.get_int()
-        res=[]
-        for i  in xrange(numrecs):
-            data = yield self.get_strpair()
-            res.append(data)
-        defer.returnValue(res)
+        return self.sock_send(self.MGET, len(klst), klst,
+                              reply=ListReply(RecvBuffer.read_strpair),
+                              shared=True)
 
-    @defer.inlineCallbacks
     def vsiz(self, key):
         """Get the size of a value for key
         """
-        yield self.sock_send(self.VSIZ, _ulen(key), key)
-        data=yield self.get_int()
-        defer.returnValue(data)
+        return self.sock_send(self.VSIZ, _ulen(key), key,
+                              reply=FieldReply(RecvBuffer.read_int),
+                              shared=True)
 
     def iterinit(self):
         """Begin iteration over all keys of the database
         """
         return self.sock_send(self.ITERINIT)
 
-    @defer.inlineCallbacks
     def iternext(self):
         """Get the next key after iterinit
         """
-        yield self.sock_send(self.ITERNEXT)
-        defer.returnValue(self.get_unicode())
+        return self.sock_send(self.ITERNEXT,
+                              reply=FieldReply(RecvBuffer.read_str, _decode))
 
-    @defer.inlineCallbacks
     def fwmkeys(self, prefix, maxkeys):
-        """Get up to the first maxkeys starting with prefix
+        """Get up to the first maxkeys starting with prefix, all of them if
+        maxkeys is negative
         """
-        yield self.sock_send(self.FWMKEYS, _ulen(prefix), maxkeys, prefix)
-        numkeys = yield self.get_int()
-        res = []
-        for i in xrange(numkeys):
-            data = yield self.get_unicode()
-            res.append(data)
-        defer.returnValue(res)
+        return self.sock_send(self.FWMKEYS, _ulen(prefix), maxkeys, prefix,
+                              reply=ListReply(RecvBuffer.read_str,
+                                              convert=_decode),
+                              shared=True)
 
-    @defer.inlineCallbacks
     def addint(self, key, num):
         """Sum given integer to existing one
         """
-        yield self.sock_send(self.ADDINT, _ulen(key), num, key)
-        res = yield self.get_int()
-        defer.returnValue(res)
+        return self.sock_send(self.ADDINT, _ulen(key), num, key,
+                              reply=FieldReply(RecvBuffer.read_int))
 
-    @defer.inlineCallbacks
     def adddouble(self, key, num):
         """Sum given double to existing one
         """
         fracpart, intpart = math.modf(num)
         fracpart, intpart = int(fracpart * 1e12), int(intpart)
-        yield self.sock_send(self.ADDDOUBLE, _ulen(key), long(intpart), 
-                        long(fracpart), key)
-        res = yield self.get_double()
-        defer.returnValue(res)
+        return self.sock_send(self.ADDDOUBLE, _ulen(key), long(intpart), 
+                              long(fracpart), key,
+                              reply=FieldReply(RecvBuffer.read_double))
 
     def ext(self, func, opts, key, value):
         """Call func(key, value) with opts
 
         opts is a bitflag that can be RDBXOLCKREC for record locking
         and/or RDBXOLCKGLB for global locking"""
-        yield self.sock_send(self.EXT, len(func), opts, _ulen(key), _ulen(value),
-                        func, key, value)
-        res = yield self.get_unicode()
-        defer.returnValue(res)
+        return self.sock_send(self.EXT, len(func), opts, _ulen(key),
+                              _ulen(value), func, key, value,
+                              reply=FieldReply(RecvBuffer.read_str, _decode))
 
     def sync(self):
         """Synchronize the database
@@ -390,48 +829,54 @@ class TyrantProtocol(protocol.Protocol):
         """
         return self.sock_send(self.SETMST, len(host), port, host)
 
-    @defer.inlineCallbacks
     def rnum(self):
         """Get the number of records in the database
         """
-        yield self.sock_send(self.RNUM)
-        res = yield self.get_long()
-        defer.returnValue(res)
+        return self.sock_send(self.RNUM,
+                              reply=FieldReply(RecvBuffer.read_long),
+                              shared=True)
 
-    @defer.inlineCallbacks
     def size(self):
         """Get the size of the database
         """
-        yield self.sock_send(self.SIZE)
-        res = yield self.get_long()
-        defer.returnValue(res)
+        return self.sock_send(self.SIZE,
+                              reply=FieldReply(RecvBuffer.read_long),
+                              shared=True)
 
-    @defer.inlineCallbacks
     def stat(self):
         """Get some statistics about the database
         """
-        yield self.sock_send(self.STAT)
-        res = yield self.get_unicode()
-        defer.returnValue(res)
+        return self.sock_send(self.STAT,
+                              reply=FieldReply(RecvBuffer.read_str, _decode),
+                              shared=True)
 
     def search(self, conditions, limit=10, offset=0, 
-               order_type=0, order_field=None, opts=0):
+               order_type=0, order_field=None, opts=0, columns=None,
+               literal=False, count=False, out=False):
         """Search table elements. args should be (field, opt, expr) tuple
+        If columns is given, records with primary key (column named '') and
+        these columns are returned instead of keys, all columns if it is
+        empty.
+        If count is set only the number of found records is returned, as
+        the only element of result. If out is set found records are removed.
         """
-        args = ["addcond\x00%s\x00%d\x00%s" % cond for cond in conditions]
+        query = compile_query(conditions, order_type, order_field, columns,
+                              count, out)
+        return self.search_compiled(query, limit, offset, opts, literal)
 
-        # Set order in query
-        if order_field:
-            args += ['setorder\x00%s\x00%d' % (order_field, order_type)]
-
-        # Set limit and offset
-        if limit > 0 and offset >= 0:
-            args += ['setlimit\x00%d\x00%d' % (limit, offset)]
-
-        return self.misc('search', args, opts)
-
-    @defer.inlineCallbacks
-    def misc(self, func, args, opts=0):
+    def search_compiled(self, query, limit=10, offset=0, opts=0,
+                        literal=False):
+        """Search table elements with a CompiledQuery
+        """
+        nargs, payload = query.args(limit, offset)
+        convert = None if literal else _decode
+        return self.sock_send(self.MISC, len('search'), opts, nargs, 'search',
+                              *payload,
+                              reply=ListReply(RecvBuffer.read_str, True,
+                                              convert),
+                              shared=not query.out)
+
+    def misc(self, func, args, opts=0, literal=False):
         """All databases support "putlist", "outlist", and "getlist".
         "putlist" is to store records. It receives keys and values one after
         the other, and returns an empty list.
@@ -442,17 +887,1690 @@ class TyrantProtocol(protocol.Protocol):
         Table database supports "setindex", "search", "genuid".
         opts is a bitflag that can be:
             RDBMONOULOG to prevent writing to the update log
+        If literal is set strings are returned instead of unicode.
         """
+        convert = None if literal else _decode
+        # Search with "out" removes found records
+        shared = func in self.READ_MISC and 'out' not in args
+        # Number of records is sent even if the call has failed
+        return self.sock_send(self.MISC, len(func), opts, len(args), func, args,
+                    reply=ListReply(RecvBuffer.read_str, True, convert),
+                    shared=shared)
+
+
+# Command names by code
+_COMMANDS = dict((getattr(TyrantProtocol, name), name.lower()) for name in (
+    'PUT', 'PUTKEEP', 'PUTCAT', 'PUTSHL', 'PUTNR', 'OUT', 'GET', 'MGET',
+    'VSIZ', 'ITERINIT', 'ITERNEXT', 'FWMKEYS', 'ADDINT', 'ADDDOUBLE', 'EXT',
+    'SYNC', 'VANISH', 'COPY', 'RESTORE', 'SETMST', 'RNUM', 'SIZE', 'STAT',
+    'MISC'))
+
+
+def _command_name(args):
+    # Misc calls are told apart by their function
+    if args[0] == TyrantProtocol.MISC:
+        return 'misc:' + args[4]
+    return _COMMANDS.get(args[0], str(args[0]))
+
+
+def _measured(result, metrics, context):
+    if isinstance(result, failure.Failure):
+        metrics.done(context, result)
+    else:
+        metrics.done(context, None)
+    return result
+
+
+class Metrics(object):
+    """Metrics and tracing hooks of TyrantProtocol, set as its metrics
+    attribute (of the class for all connections). This base does nothing,
+    subclasses override what they need.
+
+    sent() is called for every command written or queued, with its name
+    ("get", "misc:getlist", ...), request size and the number of replies
+    the connection was waiting for. What it returns is given back to
+    done() with the failure of the command, or None, once its reply has
+    come. received() is called with the size of every received chunk.
+    """
+
+    def sent(self, proto, name, size, depth):
+        return None
+
+    def done(self, context, reason):
+        pass
+
+    def received(self, proto, size):
+        pass
+
+
+class MetricsCollector(Metrics):
+    """Collects per command counts, request bytes, errors by TyrantError
+    code (or failure type) and latency histograms, received bytes and the
+    deepest recv_fifo seen. Latencies are counted in power of two buckets
+    of microseconds. stats() returns them all as a dict.
+    """
+
+    def __init__(self, timer=timeit.default_timer):
+        self.timer = timer
+        self.commands = {}
+        self.bytes_received = 0
+        self.max_depth = 0
+
+    def sent(self, proto, name, size, depth):
+        command = self.commands.get(name)
+        if command is None:
+            command = self.commands[name] = {
+                'count': 0, 'bytes_sent': 0, 'errors': {},
+                'latency': [0] * 64}
+        command['count'] += 1
+        command['bytes_sent'] += size
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return command, self.timer()
+
+    def done(self, context, reason):
+        command, start = context
+        micros = int((self.timer() - start) * 1e6)
+        command['latency'][min(63, micros.bit_length())] += 1
+        if reason is not None:
+            if reason.check(TyrantError):
+                code = reason.value.args[0]
+            else:
+                code = reason.type.__name__
+            errors = command['errors']
+            errors[code] = errors.get(code, 0) + 1
+
+    def received(self, proto, size):
+        self.bytes_received += size
+
+    @staticmethod
+    def percentile(histogram, fraction):
+        """Upper bound in microseconds of the bucket holding fraction of
+        counted latencies"""
+        total = sum(histogram)
+        if not total:
+            return None
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= fraction * total:
+                return 1 << bucket
+        return None
+
+    def stats(self):
+        """Collected metrics as a dict"""
+        commands = {}
+        for name, command in self.commands.iteritems():
+            histogram = command['latency']
+            commands[name] = {
+                'count': command['count'],
+                'bytes_sent': command['bytes_sent'],
+                'errors': dict(command['errors']),
+                'p50_us': self.percentile(histogram, 0.5),
+                'p99_us': self.percentile(histogram, 0.99)}
+        return {'commands': commands, 'bytes_received': self.bytes_received,
+                'max_depth': self.max_depth}
+
+
+class KeyIterator(object):
+    """Walks all keys of a database with ITERINIT/ITERNEXT on one connection.
+    Up to window ITERNEXT requests are kept in flight and keys are given to
+    consumer in lists of batch_size. If consumer returns a deferred, no more
+    keys are requested or given to it until the deferred fires, so memory
+    use stays within window + batch_size keys however big the database is.
+
+    Usage:
+        d = KeyIterator(proto, consumer).start()
+
+    start() returns a deferred fired with the number of keys walked.
+    """
+
+    def __init__(self, proto, consumer, batch_size=100, window=32):
+        self.proto = proto
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.window = window
+        self.count = 0
+        self._batch = []
+        self._inflight = 0
+        self._end = False
+        self._paused = False
+        self._failure = None
+        self._finished = defer.Deferred()
+
+    def start(self):
+        """Start walking, returns deferred fired with number of keys"""
+        self.proto.iterinit().addErrback(self._abort)
+        self._fill()
+        return self._finished
+
+    def _fill(self):
+        while not self._end and self._inflight < self.window and \
+                len(self._batch) + self._inflight < self.batch_size + \
+                (0 if self._paused else self.window):
+            self._inflight += 1
+            self.proto.iternext().addCallbacks(self._got, self._failed)
+
+    def _got(self, key):
+        self._inflight -= 1
+        if self._end:
+            # Aborted, finish when the last reply is in
+            self._deliver()
+            return
+        self._batch.append(key)
+        if len(self._batch) >= self.batch_size:
+            self._deliver()
+        self._fill()
+
+    def _failed(self, reason):
+        self._inflight -= 1
+        if not reason.check(TyrantError):
+            # Remember the first real failure
+            self._abort(reason)
+        # No more keys
+        self._end = True
+        if not self._inflight:
+            self._deliver()
+
+    def _deliver(self):
+        while not self._paused and (len(self._batch) >= self.batch_size or
+                                    (self._end and self._batch)):
+            keys = self._batch[:self.batch_size]
+            del self._batch[:self.batch_size]
+            self.count += len(keys)
+            try:
+                res = self.consumer(keys)
+            except Exception:
+                self._abort(failure.Failure())
+                res = None
+            if isinstance(res, defer.Deferred):
+                self._paused = True
+                res.addCallbacks(self._resume, self._abort)
+        if self._end and not self._inflight and not self._paused and \
+                not self._batch and not self._finished.called:
+            if self._failure is not None:
+                self._finished.errback(self._failure)
+            else:
+                self._finished.callback(self.count)
+
+    def _resume(self, result):
+        self._paused = False
+        self._deliver()
+        self._fill()
+
+    def _abort(self, reason):
+        if self._failure is None:
+            self._failure = reason
+        self._end = True
+        self._paused = False
+        del self._batch[:]
+        self._deliver()
+
+
+def _prefix_end(prefix):
+    """Smallest key greater than all keys starting with prefix, None if
+    there is no such key"""
+    prefix = _bytes(prefix).rstrip('\xff')
+    if prefix:
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class PrefixScanner(object):
+    """Scans keys starting with prefix page by page. consumer is called
+    with every page: a list of keys, or of (key, value) pairs if values is
+    set. The next page is fetched while consumer processes the current one,
+    and if consumer returns a deferred the scan waits for it, so at most two
+    pages are kept in memory.
+
+    On ordered (B+ tree) databases pages come from misc "range", each one
+    resuming after the last key seen, with values in the same reply. Other
+    databases can't resume a scan, there keys come from a single fwmkeys
+    and values, if needed, are fetched page by page with "getlist".
+
+    start() returns a deferred fired with the number of scanned keys.
+    """
+
+    def __init__(self, proto, prefix, consumer, page_size=1000,
+                 values=False, ordered=True, literal=False):
+        assert page_size > 1, "Page size must be greater than 1"
+        self.proto = proto
+        self.prefix = prefix
+        self.consumer = consumer
+        self.page_size = page_size
+        self.values = values
+        self.ordered = ordered
+        self.literal = literal
+        self._begin = prefix
+        self._stop = _prefix_end(prefix)
+        self._last = None
+        self._end = False
+        self._keys = None
+        self._pos = 0
+
+    @defer.inlineCallbacks
+    def start(self):
+        """Start scanning, returns deferred fired with number of keys"""
+        count = 0
+        fetching = self._fetch()
+        while True:
+            page = yield fetching
+            if not page:
+                break
+            # Next page is on its way while consumer works on this one
+            fetching = self._fetch()
+            yield self.consumer(page)
+            count += len(page)
+        defer.returnValue(count)
+
+    def _fetch(self):
+        if not self.ordered:
+            return self._fetch_keys()
+        if self._end:
+            return defer.succeed(None)
+        args = [self._begin, str(self.page_size)]
+        if self._stop is not None:
+            args.append(self._stop)
+        d = self.proto.misc('range', args, 0, self.literal)
+        return d.addCallback(self._got_range)
+
+    def _got_range(self, rval):
+        pairs = zip(rval[::2], rval[1::2])
+        if len(pairs) < self.page_size:
+            self._end = True
+        # Range starts at the last key of previous page
+        if pairs and pairs[0][0] == self._last:
+            del pairs[0]
+        if pairs:
+            self._last = self._begin = pairs[-1][0]
+        if self.values:
+            return pairs
+        return [key for key, value in pairs]
+
+    def _fetch_keys(self):
+        if self._keys is None:
+            d = self.proto.fwmkeys(self.prefix, -1)
+            return d.addCallback(self._got_keys)
+        keys = self._keys[self._pos:self._pos + self.page_size]
+        self._pos += self.page_size
+        if not keys or not self.values:
+            return defer.succeed(keys)
+        d = self.proto.misc('getlist', keys, 0, self.literal)
+        return d.addCallback(lambda rval: zip(rval[::2], rval[1::2]))
+
+    def _got_keys(self, keys):
+        self._keys = keys
+        return self._fetch_keys()
+
+
+class BulkLoader(object):
+    """Loads (key, value) pairs from any iterable, e.g. a generator, with
+    misc "putlist". Pairs are sent in batches of at most max_records pairs
+    or max_bytes of keys and values, and up to window batches are kept in
+    flight, so memory use is bounded however long the iterable is. On a
+    TyrantPool batches are spread over its connections. opts are given to
+    every putlist, e.g. RDBMONOULOG.
+
+    report, if given, is called with stats() at most every report_interval
+    seconds while loading and once when it is done.
+
+    Usage:
+        d = BulkLoader(pool, pairs, window=8).start()
+
+    start() returns a deferred fired with the final stats().
+    """
+
+    def __init__(self, proto, items, max_records=1000,
+                 max_bytes=1024 * 1024, window=4, opts=0, report=None,
+                 report_interval=1.0, clock=reactor):
+        self.proto = proto
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.window = window
+        self.opts = opts
+        self.report = report
+        self.report_interval = report_interval
+        self.clock = clock
+        self.records = 0
+        self.bytes = 0
+        self._items = iter(items)
+        self._started = self._reported = None
+        self._inflight = 0
+        self._end = False
+        self._failure = None
+        self._finished = defer.Deferred()
+
+    def start(self):
+        """Start loading, returns deferred fired with stats"""
+        self._started = self._reported = self.clock.seconds()
+        self._fill()
+        return self._finished
+
+    def stats(self):
+        """Loaded records and bytes, time taken and rates as a dict"""
+        seconds = self.clock.seconds() - self._started
+        return {'records': self.records, 'bytes': self.bytes,
+                'seconds': seconds,
+                'records_per_sec': self.records / seconds if seconds else 0.0,
+                'bytes_per_sec': self.bytes / seconds if seconds else 0.0}
+
+    def _fill(self):
+        while not self._end and self._inflight < self.window:
+            batch, size = self._next_batch()
+            if not batch:
+                self._end = True
+                break
+            self._inflight += 1
+            d = self.proto.misc('putlist', batch, self.opts)
+            d.addCallbacks(self._done, self._failed,
+                           callbackArgs=(len(batch) // 2, size))
+        self._finish()
+
+    def _next_batch(self):
+        batch = []
+        size = 0
+        max_len = 2 * self.max_records
         try:
-            yield self.sock_send(self.MISC, len(func), opts, len(args), func, args)
-        finally:
-            numrecs = yield self.get_int()
-        
+            for key, value in self._items:
+                key, value = _bytes(key), _bytes(value)
+                batch.append(key)
+                batch.append(value)
+                size += len(key) + len(value)
+                if len(batch) >= max_len or size >= self.max_bytes:
+                    break
+        except Exception:
+            self._abort(failure.Failure())
+            return [], 0
+        return batch, size
+
+    def _done(self, result, records, size):
+        self._inflight -= 1
+        self.records += records
+        self.bytes += size
+        if self.report is not None and not self._end and \
+                self.clock.seconds() - self._reported >= self.report_interval:
+            self._reported = self.clock.seconds()
+            self.report(self.stats())
+        self._fill()
+
+    def _failed(self, reason):
+        self._inflight -= 1
+        self._abort(reason)
+
+    def _abort(self, reason):
+        if self._failure is None:
+            self._failure = reason
+        self._end = True
+        self._finish()
+
+    def _finish(self):
+        if not self._end or self._inflight or self._finished.called:
+            return
+        if self._failure is not None:
+            self._finished.errback(self._failure)
+            return
+        stats = self.stats()
+        if self.report is not None:
+            self.report(stats)
+        self._finished.callback(stats)
+
+
+def _record_columns(record):
+    # Search record: primary key is in the column named ''
+    elems = record.split('\x00')
+    return dict(itertools.izip(elems[::2], elems[1::2]))
+
+
+def _drop_column(record, field):
+    # Search record without the field column
+    elems = record.split('\x00')
+    for i in xrange(0, len(elems) - 1, 2):
+        if elems[i] == field:
+            del elems[i:i + 2]
+            break
+    return '\x00'.join(elems)
+
+
+class SearchCursor(object):
+    """Streams search results window by window. consumer is called with
+    every window: a list of records with the given columns (all of them if
+    columns is empty), primary key is in the column named ''. The next
+    window is searched while consumer processes the current one, and if
+    consumer returns a deferred the cursor waits for it.
+
+    Results ordered by a number column are paged by keyset: every window
+    searches for values from the last one seen on, skipping records of the
+    previous window with that value, so deep windows cost the same as the
+    first one. The order column is always fetched then, it is removed from
+    the records given to consumer unless it is in columns. Other windows
+    are paged by offset.
+
+    start() returns a deferred fired with the number of records.
+    """
+
+    def __init__(self, proto, conditions, consumer, window=100, order_type=0,
+                 order_field=None, columns=(), literal=False):
+        assert window > 0, "Window must be greater than 0"
+        self.proto = proto
+        self.conditions = list(conditions)
+        self.consumer = consumer
+        self.window = window
+        self.order_type = order_type
+        self.order_field = order_field
+        self.literal = literal
+        self.keyset = bool(order_field) and order_type in (
+            TyrantProtocol.RDBQONUMASC, TyrantProtocol.RDBQONUMDESC)
+        columns = list(columns)
+        # Order column fetched only for keyset bookkeeping
+        self._extra = None
+        if self.keyset and columns and order_field not in columns:
+            columns.append(order_field)
+            self._extra = order_field
+        self.columns = columns
+        self._query = compile_query(self.conditions, order_type, order_field,
+                                    columns)
+        self._offset = 0
+        self._last = None
+        self._ties = set()
+        self._end = False
+
+    @defer.inlineCallbacks
+    def start(self):
+        """Start streaming, returns deferred fired with number of records"""
+        count = 0
+        fetching = self._fetch()
+        while True:
+            records = yield fetching
+            if not records:
+                break
+            # Next window is on its way while consumer works on this one
+            fetching = self._fetch()
+            yield self.consumer(records)
+            count += len(records)
+        defer.returnValue(count)
+
+    def _fetch(self):
+        if self._end:
+            return defer.succeed([])
+        if self._last is None:
+            query, limit, offset = self._query, self.window, self._offset
+        else:
+            if self.order_type == TyrantProtocol.RDBQONUMASC:
+                op = TyrantProtocol.RDBQCNUMGE
+            else:
+                op = TyrantProtocol.RDBQCNUMLE
+            # Records with the last value seen come again, they are skipped
+            query = CompiledQuery(
+                self.conditions + [(self.order_field, op, self._last)],
+                self.order_type, self.order_field, self.columns)
+            limit, offset = self.window + len(self._ties), 0
+        d = self.proto.search_compiled(query, limit, offset,
+                                       literal=self.literal)
+        return d.addCallback(self._got, limit)
+
+    def _got(self, records, limit):
+        if len(records) < limit:
+            self._end = True
+        if not self.keyset:
+            self._offset += len(records)
+            return records
+        ties = self._ties
+        if ties:
+            records = [record for record in records
+                       if record.split('\x00', 2)[1] not in ties]
+        if not records:
+            self._end = True
+            return records
+        field = self.order_field
+        last = _record_columns(records[-1]).get(field, '')
+        if self._last is None or _num(last) != _num(self._last):
+            ties = set()
+        # Keys of the trailing records with the last value
+        for record in reversed(records):
+            cols = _record_columns(record)
+            if _num(cols.get(field, '')) != _num(last):
+                break
+            ties.add(cols[''])
+        self._last, self._ties = last, ties
+        if self._extra is not None:
+            records = [_drop_column(record, self._extra) for record in records]
+        return records
+
+
+class CompiledQuery(object):
+    """Table search compiled once: conditions, order, columns and options
+    are encoded in their wire form when it is created, only limit and
+    offset are encoded on every search. It must not be changed after it is
+    created, use compile_query() to get shared compiled queries.
+    """
+
+    __slots__ = ('conditions', 'order_type', 'order_field', 'columns',
+                 'count', 'out', 'key', 'nargs', '_head', '_tail')
+
+    def __init__(self, conditions=(), order_type=0, order_field=None,
+                 columns=None, count=False, out=False):
+        self.conditions = tuple(conditions)
+        self.order_type = order_type
+        self.order_field = order_field
+        self.columns = None if columns is None else tuple(columns)
+        self.count = count
+        self.out = out
+        # Structure of the query, equal for equal queries
+        self.key = (self.conditions, order_type, order_field, self.columns,
+                    count, out)
+
+        head = ["addcond\x00%s\x00%d\x00%s" % cond for cond in conditions]
+        # Set order in query
+        if order_field:
+            head.append('setorder\x00%s\x00%d' % (order_field, order_type))
+        # Limit and offset go between head and tail
+        tail = []
+        # Get records instead of keys
+        if columns is not None:
+            tail.append('\x00'.join(['get'] + list(columns)))
+        if out:
+            tail.append('out')
+        elif count:
+            tail.append('count')
+
+        self.nargs = len(head) + len(tail)
+        self._head = _pack_args(head)
+        self._tail = _pack_args(tail)
+
+    def args(self, limit=10, offset=0):
+        """Number of search arguments and their encoded strings for given
+        limit and offset"""
+        if limit > 0 and offset >= 0:
+            limit = _pack_args(['setlimit\x00%d\x00%d' % (limit, offset)])
+            return self.nargs + 1, (self._head, limit, self._tail)
+        return self.nargs, (self._head, self._tail)
+
+
+def _pack_args(args):
+    parts = []
+    _pack_list(args, parts)
+    return ''.join(parts)
+
+
+# Process wide LRU of compiled queries
+_QUERIES = collections.OrderedDict()
+QUERY_CACHE_SIZE = 1000
+
+
+def compile_query(conditions=(), order_type=0, order_field=None,
+                  columns=None, count=False, out=False):
+    """CompiledQuery for given search, shared with all identical searches
+    in the process"""
+    key = (tuple(conditions), order_type, order_field,
+           None if columns is None else tuple(columns), count, out)
+    try:
+        query = _QUERIES.pop(key)
+    except KeyError:
+        query = CompiledQuery(conditions, order_type, order_field, columns,
+                              count, out)
+    except TypeError:
+        # Unhashable expression, can't be shared
+        return CompiledQuery(conditions, order_type, order_field, columns,
+                             count, out)
+    _QUERIES[key] = query
+    if len(_QUERIES) > QUERY_CACHE_SIZE:
+        _QUERIES.popitem(last=False)
+    return query
+
+
+class TyrantFactory(protocol.ReconnectingClientFactory):
+    """Keeps one persistent connection to ttserver and reconnects it when
+    it is lost. Current connection is in proto attribute, it is usable as
+    soon as it is built: commands wait until the connection is made.
+    """
+
+    protocol = TyrantProtocol
+
+    def __init__(self, pool=None, pipeline_depth=None, timeout=None,
+                 metrics=None):
+        self.pool = pool
+        self.pipeline_depth = pipeline_depth
+        self.timeout = timeout
+        self.metrics = metrics
+        self.proto = None
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        proto = self.protocol(self.pipeline_depth, self.timeout)
+        proto.factory = self
+        if self.metrics is not None:
+            proto.metrics = self.metrics
+        self.proto = proto
+        if self.pool is not None:
+            proto.inflight = self.pool.inflight
+            self.pool._connected(self)
+        return proto
+
+    def clientConnectionLost(self, connector, reason):
+        self.proto = None
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.pool is not None:
+            self.pool._failed(self, reason)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+
+class TyrantPool(object):
+    """Pool of persistent connections to one ttserver. Every command goes
+    to the connection with the fewest pending commands, so the pool has the
+    same commands as TyrantProtocol and can be given to Tyrant instead of a
+    single connection.
+
+    Iteration (iterinit/iternext) is bound to a connection, so it is not
+    dispatched: take a connection with least_busy() and iterate on it.
+
+    Commands have timeout seconds deadline if it is given, it includes
+    waiting for a connection when none is usable. If breaker (a
+    CircuitBreaker) is given, commands fail fast with CircuitOpen while
+    the server is unhealthy, failed connection attempts count as failures
+    too. metrics (see Metrics) is set on all
+    connections if it is given.
+
+    Usage:
+        pool = TyrantPool('127.0.0.1', 1978, size=8)
+        yield pool.connect()
+        yield pool.put('key', 'value')
+    """
+
+    # TyrantProtocol commands dispatched by the pool
+    COMMANDS = ('put', 'putkeep', 'putcat', 'putshl', 'putnr', 'out', 'get',
+                'getint', 'getdouble', 'mget', 'vsiz', 'fwmkeys', 'addint',
+                'adddouble', 'ext', 'sync', 'vanish', 'copy', 'restore',
+                'setmst', 'rnum', 'size', 'stat', 'search', 'search_compiled',
+                'misc')
+
+    factory = TyrantFactory
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, size=4,
+                 pipeline_depth=None, reactor=reactor, timeout=None,
+                 breaker=None, metrics=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.pipeline_depth = pipeline_depth
+        self.reactor = reactor
+        self.timeout = timeout
+        self.breaker = breaker
+        self.metrics = metrics
+        self.factories = []
+        # Shared reads of all connections, so writes end sharing pool wide
+        self.inflight = {}
+        self._waiting = []
+
+    def connect(self):
+        """Start connections. Returns deferred which is fired with the pool
+        when all size connections are ready, so the commands sent after it
+        are spread over all of them"""
+        while len(self.factories) < self.size:
+            factory = self.factory(self, self.pipeline_depth, self.timeout,
+                                   self.metrics)
+            self.factories.append(factory)
+            self.reactor.connectTCP(self.host, self.port, factory)
+        return self.ready(self.size)
+
+    def disconnect(self):
+        """Close all connections and stop reconnecting, commands waiting
+        for a connection fail with ConnectionDone"""
+        for factory in self.factories:
+            factory.stopTrying()
+            if factory.proto is not None and factory.proto.transport:
+                factory.proto.transport.loseConnection()
+        del self.factories[:]
+        self._fail_waiting(error.ConnectionDone('Pool is disconnected'))
+
+    def ready(self, count=1):
+        """Deferred which is fired with the pool when count connections are
+        ready, it fails with TimeoutError after timeout seconds if it is
+        given"""
+        if len(self.connections) >= count:
+            return defer.succeed(self)
+        d = defer.Deferred(self._unwait)
+        self._waiting.append((count, d))
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, self.reactor)
+        return d
+
+    @property
+    def connections(self):
+        """Usable connections"""
+        return [f.proto for f in self.factories
+                if f.proto is not None and f.proto.lost_reason is None]
+
+    @property
+    def pending(self):
+        """Number of commands waiting for their reply on all connections"""
+        return sum(proto.pending for proto in self.connections)
+
+    def least_busy(self):
+        """Connection with the fewest pending commands, None if there are
+        no usable connections"""
+        best = None
+        for proto in self.connections:
+            if best is None or proto.pending < best.pending:
+                best = proto
+                if not best.pending:
+                    break
+        return best
+
+    def _connected(self, factory):
+        usable = len(self.connections)
+        waiting = self._waiting
+        self._waiting = [(count, d) for count, d in waiting if count > usable]
+        for count, d in waiting:
+            if count <= usable:
+                d.callback(self)
+
+    def _failed(self, factory, reason):
+        if self.breaker is not None:
+            self.breaker.failed(reason)
+            if self.breaker.state == 'open':
+                self._fail_waiting(CircuitOpen())
+
+    def _fail_waiting(self, exc):
+        waiting, self._waiting = self._waiting, []
+        for count, d in waiting:
+            d.errback(exc)
+
+    def _unwait(self, d):
+        self._waiting = [(count, waiter) for count, waiter in self._waiting
+                         if waiter is not d]
+
+    def _dispatch(self, name, args, kwargs):
+        if self.breaker is not None:
+            return self.breaker.call(self._send, name, args, kwargs)
+        return self._send(name, args, kwargs)
+
+    def _send(self, name, args, kwargs):
+        proto = self.least_busy()
+        if proto is None:
+            # Wait for reconnection
+            d = self.ready()
+            d.addCallback(lambda pool: pool._send(name, args, kwargs))
+            return d
+        return getattr(proto, name)(*args, **kwargs)
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while a server is unhealthy. After threshold
+    failures in a row the circuit opens: calls fail with CircuitOpen at
+    once. After reset_timeout seconds one call is let through, the circuit
+    closes if it succeeds and opens again if it fails.
+
+    TyrantError is not a failure, the server reports it when it is
+    healthy, and neither is a cancelled call. Failures seen outside of
+    call() (e.g. failed connection attempts) are recorded with failed().
+    """
+
+    def __init__(self, threshold=5, reset_timeout=10.0, clock=reactor):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened = None
+        self._probing = False
+
+    @property
+    def state(self):
+        """"closed", "open" or "half-open" when a call is let through"""
+        if self.opened is None:
+            return 'closed'
+        return 'half-open' if self._probing else 'open'
+
+    def call(self, func, *args, **kwargs):
+        """Call func returning a deferred unless the circuit is open"""
+        probe = False
+        if self.opened is not None:
+            if self._probing or \
+                    self.clock.seconds() - self.opened < self.reset_timeout:
+                return defer.fail(CircuitOpen())
+            probe = self._probing = True
+        d = defer.maybeDeferred(func, *args, **kwargs)
+        return d.addBoth(self._record, probe)
+
+    def failed(self, reason):
+        """Record a failure, reason is a Failure or an exception"""
+        if not isinstance(reason, failure.Failure):
+            reason = failure.Failure(reason)
+        self._record(reason, False)
+
+    def _record(self, result, probe):
+        if probe:
+            self._probing = False
+        if not isinstance(result, failure.Failure) or \
+                result.check(TyrantError):
+            self.failures = 0
+            self.opened = None
+        elif not result.check(defer.CancelledError, CircuitOpen):
+            self.failures += 1
+            if probe or self.failures >= self.threshold:
+                self.opened = self.clock.seconds()
+        return result
+
+
+def _pooled(name):
+    def command(self, *args, **kwargs):
+        return self._dispatch(name, args, kwargs)
+    command.__name__ = name
+    command.__doc__ = getattr(TyrantProtocol, name).__doc__
+    return command
+
+for _name in TyrantPool.COMMANDS:
+    setattr(TyrantPool, _name, _pooled(_name))
+del _name
+
+def _gather(deferreds):
+    """gatherResults which fails with the first original failure"""
+    d = defer.gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(lambda failure: failure.value.subFailure)
+    return d
+
+
+class _Desc(object):
+    """Sort key wrapper which reverses the order of wrapped value"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _num(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _merge_search(results, order_type, order_field, offset, limit,
+                  records=False):
+    """Merge search results of many shards. With order_field results are
+    records with the order column, they are k-way merged by it. Keys are
+    returned unless records is set"""
+    if order_field:
+        if order_type in (TyrantProtocol.RDBQONUMASC,
+                          TyrantProtocol.RDBQONUMDESC):
+            sortkey = _num
+        else:
+            sortkey = lambda value: value or u''
+        reverse = order_type in (TyrantProtocol.RDBQOSTRDESC,
+                                 TyrantProtocol.RDBQONUMDESC)
+        streams = []
+        for shard, result in enumerate(results):
+            stream = []
+            for pos, record in enumerate(result):
+                elems = record.split('\x00')
+                cols = dict(itertools.izip(elems[::2], elems[1::2]))
+                value = sortkey(cols.get(order_field))
+                if reverse:
+                    value = _Desc(value)
+                stream.append((value, shard, pos,
+                               record if records else cols.get('')))
+            streams.append(stream)
+        merged = (item[3] for item in heapq.merge(*streams))
+    else:
+        merged = itertools.chain(*results)
+    stop = offset + limit if limit else None
+    return list(itertools.islice(merged, offset, stop))
+
+
+class HashRing(object):
+    """Consistent hash ring. Every node is put on the ring replicas times
+    (virtual nodes), so keys are spread evenly and adding or removing a node
+    moves only its share of keys.
+    """
+
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self._hashes = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        if isinstance(key, unicode):
+            key = key.encode(ENCODING)
+        elif not isinstance(key, str):
+            key = str(key)
+        return struct.unpack('>I', hashlib.md5(key).digest()[:4])[0]
+
+    def add(self, node):
+        """Add node, which is a string name of the node"""
+        for i in xrange(self.replicas):
+            h = self.hash('%s-%d' % (node, i))
+            if h not in self._nodes:
+                bisect.insort(self._hashes, h)
+            self._nodes[h] = node
+
+    def remove(self, node):
+        for i in xrange(self.replicas):
+            h = self.hash('%s-%d' % (node, i))
+            if self._nodes.get(h) == node:
+                del self._nodes[h]
+                self._hashes.remove(h)
+
+    def get(self, key):
+        """Node for given key"""
+        if not self._hashes:
+            raise LookupError("Hash ring is empty")
+        i = bisect.bisect(self._hashes, self.hash(key))
+        if i == len(self._hashes):
+            i = 0
+        return self._nodes[self._hashes[i]]
+
+
+class TyrantShards(object):
+    """Client for data sharded over many ttservers. Keys are routed with
+    consistent hashing, batch commands are split into parallel per shard
+    commands and their results are merged.
+
+    shards is a dict of shard name (usually "host:port", it must not change
+    between restarts) and TyrantProtocol or TyrantPool connected to it.
+
+    Usage:
+        shards = TyrantShards({'db1:1978': pool1, 'db2:1978': pool2})
+        yield shards.put('key', 'value')
+        pairs = yield shards.mget(['key', 'other'])
+    """
+
+    # Commands routed by their first argument
+    KEY_COMMANDS = ('put', 'putkeep', 'putcat', 'putshl', 'putnr', 'out',
+                    'get', 'getint', 'getdouble', 'vsiz', 'addint',
+                    'adddouble')
+
+    # Misc functions receiving a key as their first argument
+    KEY_MISC = ('put', 'putkeep', 'putcat', 'out', 'get')
+
+    def __init__(self, shards, replicas=160):
+        self.shards = dict(shards)
+        self.ring = HashRing(sorted(self.shards), replicas)
+
+    def shard(self, key):
+        """Connection of the shard that keeps key"""
+        return self.shards[self.ring.get(key)]
+
+    def _split(self, keys):
+        """Group keys by shard connection"""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.get(key), []).append(key)
+        return dict((self.shards[name], keys)
+                    for name, keys in groups.iteritems())
+
+    def _concat(self, deferreds):
+        d = _gather(deferreds)
+        d.addCallback(lambda results: sum(results, []))
+        return d
+
+    def _all(self, name, *args):
+        return _gather([getattr(proto, name)(*args)
+                        for n, proto in sorted(self.shards.iteritems())])
+
+    def mget(self, klst):
+        """Get key,value pairs from all shards for the given list of keys
+        """
+        return self._concat([proto.mget(keys) for proto, keys
+                             in self._split(klst).iteritems()])
+
+    def misc(self, func, args, opts=0, literal=False):
+        """Sharded misc: "getlist" and "outlist" keys and "putlist" pairs
+        are sent to their shards in parallel and results are merged.
+        Single record table functions are routed by key, "setindex" is sent
+        to all shards.
+        """
+        if func in ('getlist', 'outlist'):
+            return self._concat([proto.misc(func, keys, opts, literal)
+                                 for proto, keys
+                                 in self._split(args).iteritems()])
+        elif func == 'putlist':
+            groups = {}
+            for i in xrange(0, len(args), 2):
+                name = self.ring.get(args[i])
+                groups.setdefault(name, []).extend(args[i:i + 2])
+            return self._concat([self.shards[name].misc(func, pairs, opts)
+                                 for name, pairs in groups.iteritems()])
+        elif func in self.KEY_MISC:
+            return self.shard(args[0]).misc(func, args, opts, literal)
+        elif func == 'setindex':
+            return self._all('misc', func, args, opts).addCallback(
+                lambda results: results[0])
+        raise ValueError("Misc function %s can not be sharded" % func)
+
+    def search(self, conditions, limit=10, offset=0, order_type=0,
+               order_field=None, opts=0, columns=None, literal=False,
+               count=False, out=False):
+        """Search table elements on all shards concurrently. Every shard is
+        asked for offset + limit keys, ordered results are merged according
+        to order_type and then offset and limit are applied to the merged
+        result. Counts are summed, out removes found records on all shards,
+        both ignore limit and offset.
+        """
+        if count or out:
+            d = self._all('search', conditions, 0, 0, order_type, order_field,
+                          opts, None, literal, count, out)
+            if out:
+                return d.addCallback(lambda results: [])
+            return d.addCallback(lambda results: [unicode(
+                sum(int(res[0]) for res in results if res))])
+
+        if limit > 0 and offset >= 0:
+            shard_limit = offset + limit
+        else:
+            shard_limit, offset, limit = 0, 0, 0
+        records = columns is not None
+        # Values of the order column are needed to merge shard results
+        extra = bool(order_field and columns and order_field not in columns)
+        if extra:
+            columns = list(columns) + [order_field]
+        elif order_field and not records:
+            columns = [order_field]
+        d = self._all('search', conditions, shard_limit, 0, order_type,
+                      order_field, opts, columns, literal)
+        d.addCallback(_merge_search, order_type, order_field, offset, limit,
+                      records)
+        if extra:
+            d.addCallback(lambda merged: [_drop_column(record, order_field)
+                                          for record in merged])
+        return d
+
+    def search_compiled(self, query, limit=10, offset=0, opts=0,
+                        literal=False):
+        """Search table elements on all shards with a CompiledQuery
+        """
+        return self.search(query.conditions, limit, offset, query.order_type,
+                           query.order_field, opts, query.columns, literal,
+                           query.count, query.out)
+
+    def rnum(self):
+        """Get the number of records in all shards
+        """
+        return self._all('rnum').addCallback(sum)
+
+    def size(self):
+        """Get the size of all shards
+        """
+        return self._all('size').addCallback(sum)
+
+    def stat(self):
+        """Get statistics of the first shard, all shards are expected to
+        have the same database type
+        """
+        name = min(self.shards)
+        return self.shards[name].stat()
+
+    def sync(self):
+        """Synchronize all shards
+        """
+        return self._all('sync').addCallback(lambda results: True)
+
+    def vanish(self):
+        """Remove all records from all shards
+        """
+        return self._all('vanish').addCallback(lambda results: True)
+
+
+def _routed(name):
+    def command(self, key, *args, **kwargs):
+        return getattr(self.shard(key), name)(key, *args, **kwargs)
+    command.__name__ = name
+    command.__doc__ = getattr(TyrantProtocol, name).__doc__
+    return command
+
+for _name in TyrantShards.KEY_COMMANDS:
+    setattr(TyrantShards, _name, _routed(_name))
+del _name
+
+def _parse_stat(stat):
+    return dict(line.split('\t', 1) for line in stat.splitlines() if line)
+
+
+class TyrantReplicas(object):
+    """Client for a replicated database: writes go to master, reads are
+    spread over replicas (slaves, or the other master of a dual master
+    setup). A read goes to the healthy replica with the fewest pending
+    commands, then the lowest stat latency, or to master if there is none.
+
+    Replicas are polled with stat every poll_interval seconds once start()
+    is called. A replica is excluded while its stat fails or while it lags:
+    its replication timestamp (rts) is more than max_lag seconds behind the
+    freshest one among the polled servers, or behind the last write sent
+    through this client. With read_your_writes set, reads only go to
+    replicas which have applied the last write of this client. Server and
+    client clocks are expected to be in sync.
+
+    rts only moves when a replica applies an update, so lag is measured
+    against the freshest polled server: writes of other clients are not
+    seen while every replica (and master, when it is a replica too) lags
+    behind them by the same time, and neither is a replica which stopped
+    replicating while no writes were made.
+
+    master and replicas are TyrantProtocol or TyrantPool instances.
+
+    Usage:
+        db = TyrantReplicas(master_pool, [slave1_pool, slave2_pool])
+        db.start()
+        yield db.put('key', 'value')
+        value = yield db.get('key')
+    """
+
+    # Commands which only read
+    READ_COMMANDS = ('get', 'getint', 'getdouble', 'mget', 'vsiz', 'fwmkeys',
+                     'rnum', 'size')
+
+    # Commands which write
+    WRITE_COMMANDS = ('put', 'putkeep', 'putcat', 'putshl', 'putnr', 'out',
+                      'addint', 'adddouble', 'ext', 'sync', 'vanish',
+                      'restore')
+
+    def __init__(self, master, replicas, poll_interval=1.0, max_lag=5.0,
+                 read_your_writes=False, clock=reactor):
+        self.master = master
+        self.replicas = list(replicas)
+        self.poll_interval = poll_interval
+        self.max_lag = max_lag
+        self.read_your_writes = read_your_writes
+        self.clock = clock
+        self.written = 0.0
+        # Replication state by replica: rts in seconds and stat latency
+        self.rts = {}
+        self.latency = {}
+        self._master_rts = 0.0
+        self._poll = task.LoopingCall(self.poll)
+        self._poll.clock = clock
+
+    def start(self):
+        """Start polling replicas"""
+        if not self._poll.running:
+            self._poll.start(self.poll_interval)
+
+    def stop(self):
+        """Stop polling replicas"""
+        if self._poll.running:
+            self._poll.stop()
+
+    def poll(self):
+        """Poll stat of master and replicas, returns deferred fired when
+        all are done"""
+        ds = [self.master.stat().addCallbacks(self._master_stat,
+                                              lambda reason: None)]
+        for proto in self.replicas:
+            d = proto.stat()
+            d.addCallbacks(self._replica_stat, self._replica_failed,
+                           (proto, self.clock.seconds()), None, (proto,))
+            ds.append(d)
+        return defer.DeferredList(ds)
+
+    def _master_stat(self, stat):
+        self._master_rts = int(_parse_stat(stat).get('rts', 0)) / 1e6
+
+    def _replica_stat(self, stat, proto, sent):
+        self.rts[proto] = int(_parse_stat(stat).get('rts', 0)) / 1e6
+        self.latency[proto] = self.clock.seconds() - sent
+
+    def _replica_failed(self, reason, proto):
+        self.rts.pop(proto, None)
+        self.latency.pop(proto, None)
+
+    def healthy(self):
+        """Replicas reads can go to"""
+        freshest = max([self.written, self._master_rts] + self.rts.values())
+        oldest = freshest - self.max_lag
+        if self.read_your_writes:
+            oldest = max(oldest, self.written)
+        return [proto for proto in self.replicas
+                if proto in self.rts and self.rts[proto] >= oldest]
+
+    def reader(self):
+        """Connection to read with"""
+        best = None
+        for proto in self.healthy():
+            score = (proto.pending, self.latency[proto])
+            if best is None or score < best[0]:
+                best = (score, proto)
+        return self.master if best is None else best[1]
+
+    def _write(self, name, args, kwargs):
+        self.written = self.clock.seconds()
+        return getattr(self.master, name)(*args, **kwargs)
+
+    def stat(self):
+        """Get the status string of master
+        """
+        return self.master.stat()
+
+    def misc(self, func, args, opts=0, literal=False):
+        """misc on a replica if it only reads, on master otherwise
+        """
+        if func in TyrantProtocol.READ_MISC and 'out' not in args:
+            return self.reader().misc(func, args, opts, literal)
+        return self._write('misc', (func, args, opts, literal), {})
+
+    def search(self, conditions, limit=10, offset=0, order_type=0,
+               order_field=None, opts=0, columns=None, literal=False,
+               count=False, out=False):
+        """search on a replica, on master if found records are removed
+        """
+        args = (conditions, limit, offset, order_type, order_field, opts,
+                columns, literal, count, out)
+        if out:
+            return self._write('search', args, {})
+        return self.reader().search(*args)
+
+    def search_compiled(self, query, limit=10, offset=0, opts=0,
+                        literal=False):
+        """search_compiled on a replica, on master if found records are
+        removed
+        """
+        args = (query, limit, offset, opts, literal)
+        if query.out:
+            return self._write('search_compiled', args, {})
+        return self.reader().search_compiled(*args)
+
+
+def _replica_read(name):
+    def command(self, *args, **kwargs):
+        return getattr(self.reader(), name)(*args, **kwargs)
+    command.__name__ = name
+    command.__doc__ = getattr(TyrantProtocol, name).__doc__
+    return command
+
+
+def _master_write(name):
+    def command(self, *args, **kwargs):
+        return self._write(name, args, kwargs)
+    command.__name__ = name
+    command.__doc__ = getattr(TyrantProtocol, name).__doc__
+    return command
+
+for _name in TyrantReplicas.READ_COMMANDS:
+    setattr(TyrantReplicas, _name, _replica_read(_name))
+for _name in TyrantReplicas.WRITE_COMMANDS:
+    setattr(TyrantReplicas, _name, _master_write(_name))
+del _name
+
+class LRUCache(object):
+    """Bounded cache with LRU eviction, per entry TTL and a byte budget for
+    values (their length unless size is given when they are set). Counts
+    hits, misses, evictions and expirations. version
+    is incremented on every invalidation, so readers can tell if an entry
+    was invalidated while its value was being fetched.
+    """
+
+    def __init__(self, maxitems=10000, maxbytes=64 * 1024 * 1024, ttl=None,
+                 clock=reactor):
+        self.maxitems = maxitems
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.clock = clock
+        self.version = 0
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Cached value for key, None if there is no valid one"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires, size = entry
+        if expires is not None and expires <= self.clock.seconds():
+            self.bytes -= size
+            self.expirations += 1
+            self.misses += 1
+            return None
+        # Most recently used entries are at the end
+        self._entries[key] = entry
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.maxbytes:
+            self.invalidate(key)
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        ttl = self.ttl if ttl is None else ttl
+        expires = self.clock.seconds() + ttl if ttl is not None else None
+        self._entries[key] = (value, expires, size)
+        self.bytes += size
+        while len(self._entries) > self.maxitems or self.bytes > self.maxbytes:
+            key, (value, expires, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.version += 1
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """Cache counters as a dict"""
+        return {'items': len(self._entries), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+def _bytes_key(key):
+    return key.encode(ENCODING) if isinstance(key, unicode) else str(key)
+
+
+class CachingProtocol(object):
+    """Read-through cache on top of TyrantProtocol, TyrantPool or
+    TyrantShards. get and misc "getlist" are served from cache (an
+    LRUCache), only missing keys are fetched from the server. Writes sent
+    through it invalidate their keys, both when they are sent and when
+    they are done. Other commands are passed through.
+
+    Search results are cached in queries (another LRUCache) if it is
+    given. Any write can change them, so every write sent through it
+    clears all of them.
+    """
+
+    # Commands writing the key given as first argument
+    KEY_WRITES = ('put', 'putkeep', 'putcat', 'putshl', 'putnr', 'out',
+                  'addint', 'adddouble')
+
+    # Misc functions writing the key given as first argument
+    KEY_MISC_WRITES = ('put', 'putkeep', 'putcat', 'out')
+
+    def __init__(self, proto, cache=None, queries=None):
+        self.proto = proto
+        # Records are not cached without cache
+        self.cache = LRUCache(maxitems=0, maxbytes=0) if cache is None \
+            else cache
+        self.queries = queries
+
+    def __getattr__(self, name):
+        return getattr(self.proto, name)
+
+    def _fill(self, value, key, version):
+        if self.cache.version == version:
+            self.cache.set(key, value)
+        return value
+
+    def _invalidated(self, result, keys):
+        for key in keys:
+            self.cache.invalidate(key)
+        if self.queries is not None:
+            self.queries.clear()
+        return result
+
+    def _write(self, keys, d):
+        self._invalidated(None, keys)
+        return d.addBoth(self._invalidated, keys)
+
+    def _cleared(self, result):
+        self.cache.clear()
+        if self.queries is not None:
+            self.queries.clear()
+        return result
+
+    def get(self, key, literal=False):
+        """Get the value of a key from cache or server
+        """
+        ckey = _bytes_key(key)
+        value = self.cache.get(ckey)
+        if value is not None:
+            d = defer.succeed(value)
+        else:
+            d = self.proto.get(key, True)
+            d.addCallback(self._fill, ckey, self.cache.version)
+        if not literal:
+            d.addCallback(lambda value: value.decode(ENCODING))
+        return d
+
+    def misc(self, func, args, opts=0, literal=False):
+        """misc with cached "getlist" and invalidation of written keys
+        """
+        if func == 'getlist':
+            return self._getlist(args, opts, literal)
+        elif func == 'putlist':
+            keys = [_bytes_key(key) for key in args[::2]]
+        elif func == 'outlist':
+            keys = [_bytes_key(key) for key in args]
+        elif func in self.KEY_MISC_WRITES and args:
+            keys = [_bytes_key(args[0])]
+        elif func in ('search', 'genuid', 'setindex', 'get') and \
+                'out' not in args:
+            return self.proto.misc(func, args, opts, literal)
+        else:
+            # Can't tell what was written
+            self._cleared(None)
+            d = self.proto.misc(func, args, opts, literal)
+            return d.addBoth(self._cleared)
+        return self._write(keys, self.proto.misc(func, args, opts, literal))
+
+    def _getlist(self, keys, opts, literal):
         res = []
-        for i in xrange(numrecs):
-            data = yield self.get_unicode()
-            res.append(data)
-        defer.returnValue(res)
+        missing = []
+        for key in keys:
+            value = self.cache.get(_bytes_key(key))
+            if value is None:
+                missing.append(key)
+            else:
+                res.extend((_bytes_key(key), value))
+        if missing:
+            d = self.proto.misc('getlist', missing, opts, True)
+            d.addCallback(self._fetched, res, self.cache.version)
+        else:
+            d = defer.succeed(res)
+        if not literal:
+            d.addCallback(lambda res: [s.decode(ENCODING) for s in res])
+        return d
+
+    def _fetched(self, rval, res, version):
+        if self.cache.version == version:
+            for i in xrange(0, len(rval) - 1, 2):
+                self.cache.set(rval[i], rval[i + 1])
+        res.extend(rval)
+        return res
+
+    def search(self, conditions, limit=10, offset=0, order_type=0,
+               order_field=None, opts=0, columns=None, literal=False,
+               count=False, out=False):
+        """Search table elements from cache or server, clearing cache if
+        found records are removed
+        """
+        query = compile_query(conditions, order_type, order_field, columns,
+                              count, out)
+        return self.search_compiled(query, limit, offset, opts, literal)
+
+    def search_compiled(self, query, limit=10, offset=0, opts=0,
+                        literal=False):
+        """Search table elements with a CompiledQuery from cache or server,
+        clearing cache if found records are removed
+        """
+        if query.out:
+            self._cleared(None)
+            d = self.proto.search_compiled(query, limit, offset, opts,
+                                           literal)
+            return d.addBoth(self._cleared)
+        if self.queries is None:
+            return self.proto.search_compiled(query, limit, offset, opts,
+                                              literal)
+        key = (query.key, limit, offset, opts, literal)
+        try:
+            res = self.queries.get(key)
+        except TypeError:
+            # Unhashable expression, can't be cached
+            return self.proto.search_compiled(query, limit, offset, opts,
+                                              literal)
+        if res is not None:
+            # Callers get their own list, the cached one stays intact
+            return defer.succeed(list(res))
+        d = self.proto.search_compiled(query, limit, offset, opts, literal)
+        return d.addCallback(self._searched, key, self.queries.version)
+
+    def _searched(self, res, key, version):
+        if self.queries.version == version:
+            self.queries.set(key, list(res), size=sum(map(len, res)))
+        return res
+
+    def vanish(self):
+        """Remove all records and clear cache
+        """
+        self._cleared(None)
+        return self.proto.vanish().addBoth(self._cleared)
+
+    def restore(self, path, msec):
+        """Restore the database from path and clear cache
+        """
+        self._cleared(None)
+        return self.proto.restore(path, msec).addBoth(self._cleared)
+
+
+def _invalidating(name):
+    def command(self, key, *args, **kwargs):
+        d = getattr(self.proto, name)(key, *args, **kwargs)
+        return self._write([_bytes_key(key)], d)
+    command.__name__ = name
+    command.__doc__ = getattr(TyrantProtocol, name).__doc__
+    return command
+
+for _name in CachingProtocol.KEY_WRITES:
+    setattr(CachingProtocol, _name, _invalidating(_name))
+del _name
+
+class BatchingProtocol(object):
+    """Collects single key get, put and out calls and sends them as one
+    misc "getlist", "putlist" or "outlist" command. A batch is sent after
+    delay seconds (0 means on the next reactor iteration) or as soon as it
+    has maxsize calls, then its result is given to every caller's deferred.
+    Other commands are passed through, the current batch is sent before
+    them so they do not overtake it.
+
+    Calls are batched in order: a call of another kind sends the current
+    batch first. Note that "outlist" ignores missing keys, so batched out
+    does not fail for them, unlike the OUT command.
+    """
+
+    BATCHES = {'get': 'getlist', 'put': 'putlist', 'out': 'outlist'}
+
+    def __init__(self, proto, maxsize=1000, delay=0, reactor=reactor):
+        self.proto = proto
+        self.maxsize = maxsize
+        self.delay = delay
+        self.reactor = reactor
+        self._func = None
+        self._batch = []
+        self._call = None
+
+    def __getattr__(self, name):
+        attr = getattr(self.proto, name)
+        if not callable(attr):
+            return attr
+        def command(*args, **kwargs):
+            self.flush()
+            return attr(*args, **kwargs)
+        return command
+
+    def get(self, key, literal=False):
+        """Get the value of a key in the next "getlist" batch
+        """
+        return self._add('getlist', (key, literal))
+
+    def put(self, key, value):
+        """Set key to value in the next "putlist" batch
+        """
+        return self._add('putlist', (key, value))
+
+    def out(self, key):
+        """Remove key in the next "outlist" batch
+        """
+        return self._add('outlist', (key,))
+
+    def _add(self, func, call):
+        if self._func != func:
+            self.flush()
+            self._func = func
+        d = defer.Deferred()
+        self._batch.append((call, d))
+        if len(self._batch) >= self.maxsize:
+            self.flush()
+        elif self._call is None:
+            self._call = self.reactor.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        """Send collected calls now"""
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        func, batch = self._func, self._batch
+        self._func, self._batch = None, []
+        if not batch:
+            return
+
+        if func == 'getlist':
+            keys = []
+            seen = set()
+            for (key, literal), d in batch:
+                key = _bytes_key(key)
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+            d = self.proto.misc(func, keys, literal=True)
+            d.addCallbacks(self._got, self._failed, (batch,), None, (batch,))
+        else:
+            args = []
+            for call, d in batch:
+                args.extend(call)
+            d = self.proto.misc(func, args)
+            d.addCallbacks(self._done, self._failed, (batch,), None, (batch,))
+
+    def _got(self, rval, batch):
+        values = dict(itertools.izip(rval[::2], rval[1::2]))
+        for (key, literal), d in batch:
+            value = values.get(_bytes_key(key))
+            if value is None:
+                # Same as GET for a missing record
+                d.errback(TyrantError(1))
+            elif literal:
+                d.callback(value)
+            else:
+                # Bad value fails its caller only, as Reply.fire does
+                try:
+                    value = value.decode(ENCODING)
+                except UnicodeDecodeError:
+                    d.errback()
+                else:
+                    d.callback(value)
+
+    def _done(self, result, batch):
+        for call, d in batch:
+            d.callback(True)
+
+    def _failed(self, failure, batch):
+        for call, d in batch:
+            d.errback(failure)
 
 ###
 # test
@@ -460,7 +2578,11 @@ class TyrantProtocol(protocol.Protocol):
 
 @defer.inlineCallbacks
 def test_proto():
-    cc = yield protocol.ClientCreator(reactor, TyrantProtocol).connectTCP("127.0.0.1",1978)
+    # Fake server imports this module
+    from tx_tokyo_fake import FakeTyrantFactory
+    port = reactor.listenTCP(0, FakeTyrantFactory(), interface='127.0.0.1')
+    cc = yield protocol.ClientCreator(reactor, TyrantProtocol).connectTCP(
+        "127.0.0.1", port.getHost().port)
     yield cc.put('test','tutu123123123123123213')
     res = yield cc.get('test')
     print res
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+In-process fake ttserver speaking the Tokyo Tyrant binary protocol, for
+benchmarks and tests which can't rely on a real server. Data lives in
+memory, in the factory. Replies can be delayed by a fixed latency and
+written in small chunks to exercise partial reads.
+
+    factory = FakeTyrantFactory('table', latency=0.001, chunk_size=7)
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+"""
+
+import collections
+import itertools
+import re
+import struct
+
+from twisted.internet import protocol, reactor
+
+from tx_tokyo import MAGIC_NUMBER, TyrantProtocol
+
+_INT = struct.Struct('>I')
+_LONG = struct.Struct('>Q')
+_DOUBLE = struct.Struct('>QQ')
+
+# Condition flags as ttserver sends them
+_NEGATE = 1 << 24
+_NOIDX = 1 << 25
+
+
+class _Incomplete(Exception):
+    """Request has not fully arrived yet"""
+
+
+class _Request(object):
+    """Reads request fields from the receive buffer at pos"""
+
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+
+    def int(self):
+        return self._unpack(_INT)[0]
+
+    def long(self):
+        return self._unpack(_LONG)[0]
+
+    def str(self, size):
+        end = self.pos + size
+        if end > len(self.buf):
+            raise _Incomplete()
+        value = str(self.buf[self.pos:end])
+        self.pos = end
+        return value
+
+    def _unpack(self, fmt):
+        if self.pos + fmt.size > len(self.buf):
+            raise _Incomplete()
+        value = fmt.unpack_from(self.buf, self.pos)
+        self.pos += fmt.size
+        return value
+
+
+def _ok(*fields):
+    return '\x00' + ''.join(fields)
+
+
+def _fail(code=1):
+    return chr(code)
+
+
+def _list(values):
+    return _ok(_INT.pack(len(values)),
+               *[_INT.pack(len(v)) + v for v in values])
+
+
+def _columns(value):
+    elems = value.split('\x00')
+    return dict(itertools.izip(elems[::2], elems[1::2]))
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _tokens(expr):
+    return [t for t in re.split('[ ,]+', expr) if t]
+
+
+def _match(cols, name, op, expr):
+    negate = op & _NEGATE
+    op &= ~(_NEGATE | _NOIDX)
+    value = cols.get(name)
+    if value is None:
+        return bool(negate)
+    if op == TyrantProtocol.RDBQCSTREQ:
+        res = value == expr
+    elif op == TyrantProtocol.RDBQCSTRINC:
+        res = expr in value
+    elif op == TyrantProtocol.RDBQCSTRBW:
+        res = value.startswith(expr)
+    elif op == TyrantProtocol.RDBQCSTREW:
+        res = value.endswith(expr)
+    elif op == TyrantProtocol.RDBQCSTRAND:
+        res = all(t in value for t in _tokens(expr))
+    elif op == TyrantProtocol.RDBQCSTROR:
+        res = any(t in value for t in _tokens(expr))
+    elif op == TyrantProtocol.RDBQCSTROREQ:
+        res = value in _tokens(expr)
+    elif op == TyrantProtocol.RDBQCSTRRX:
+        res = re.search(expr, value) is not None
+    elif op == TyrantProtocol.RDBQCNUMBT:
+        low, high = sorted(map(_number, _tokens(expr)[:2]))
+        res = low <= _number(value) <= high
+    elif op == TyrantProtocol.RDBQCNUMOREQ:
+        res = _number(value) in map(_number, _tokens(expr))
+    else:
+        value, expr = _number(value), _number(expr)
+        res = {TyrantProtocol.RDBQCNUMEQ: value == expr,
+               TyrantProtocol.RDBQCNUMGT: value > expr,
+               TyrantProtocol.RDBQCNUMGE: value >= expr,
+               TyrantProtocol.RDBQCNUMLT: value < expr,
+               TyrantProtocol.RDBQCNUMLE: value <= expr}.get(op, False)
+    return not res if negate else res
+
+
+class FakeTyrant(protocol.Protocol):
+    """Server side of one connection to FakeTyrantFactory"""
+
+    def connectionMade(self):
+        self._buf = bytearray()
+        self._out = collections.deque()
+        self._flush_call = None
+        self._iter = None
+
+    def dataReceived(self, data):
+        self._buf.extend(data)
+        pos = 0
+        while len(self._buf) - pos >= 2:
+            if self._buf[pos] != MAGIC_NUMBER:
+                self.transport.loseConnection()
+                return
+            handler = self.HANDLERS.get(self._buf[pos + 1])
+            if handler is None:
+                self.transport.loseConnection()
+                return
+            req = _Request(self._buf, pos + 2)
+            try:
+                reply = handler(self, req)
+            except _Incomplete:
+                break
+            pos = req.pos
+            if reply is not None:
+                self._send(reply)
+        del self._buf[:pos]
+
+    def _send(self, data):
+        factory = self.factory
+        if not factory.latency and not factory.chunk_size and not self._out:
+            self.transport.write(data)
+            return
+        due = factory.clock.seconds() + factory.latency
+        size = factory.chunk_size or len(data)
+        for i in xrange(0, len(data), size):
+            self._out.append((due, data[i:i + size]))
+        if self._flush_call is None:
+            self._schedule()
+
+    def _schedule(self):
+        delay = max(0, self._out[0][0] - self.factory.clock.seconds())
+        self._flush_call = self.factory.clock.callLater(delay, self._flush)
+
+    def _flush(self):
+        self._flush_call = None
+        now = self.factory.clock.seconds()
+        chunked = bool(self.factory.chunk_size)
+        while self._out and self._out[0][0] <= now:
+            self.transport.write(self._out.popleft()[1])
+            if chunked:
+                # One chunk per reactor iteration
+                break
+        if self._out and self.transport.connected:
+            self._schedule()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+
+    # Commands
+
+    def _put(self, req):
+        ksiz, vsiz = req.int(), req.int()
+        return req.str(ksiz), req.str(vsiz)
+
+    def put(self, req):
+        key, value = self._put(req)
+        self.factory.db[key] = value
+        return _ok()
+
+    def putkeep(self, req):
+        key, value = self._put(req)
+        if key in self.factory.db:
+            return _fail()
+        self.factory.db[key] = value
+        return _ok()
+
+    def putcat(self, req):
+        key, value = self._put(req)
+        db = self.factory.db
+        db[key] = db.get(key, '') + value
+        return _ok()
+
+    def putshl(self, req):
+        ksiz, vsiz, width = req.int(), req.int(), req.int()
+        key, value = req.str(ksiz), req.str(vsiz)
+        db = self.factory.db
+        db[key] = (db.get(key, '') + value)[-width:] if width else ''
+        return _ok()
+
+    def putnr(self, req):
+        key, value = self._put(req)
+        self.factory.db[key] = value
+
+    def out(self, req):
+        key = req.str(req.int())
+        if self.factory.db.pop(key, None) is None:
+            return _fail()
+        return _ok()
+
+    def get(self, req):
+        value = self.factory.db.get(req.str(req.int()))
+        if value is None:
+            return _fail()
+        return _ok(_INT.pack(len(value)), value)
+
+    def mget(self, req):
+        keys = [req.str(req.int()) for i in xrange(req.int())]
+        db = self.factory.db
+        pairs = [(k, db[k]) for k in keys if k in db]
+        return _ok(_INT.pack(len(pairs)),
+                   *[_INT.pack(len(k)) + _INT.pack(len(v)) + k + v
+                     for k, v in pairs])
+
+    def vsiz(self, req):
+        value = self.factory.db.get(req.str(req.int()))
+        if value is None:
+            return _fail()
+        return _ok(_INT.pack(len(value)))
+
+    def iterinit(self, req):
+        self._iter = iter(self.factory.keys())
+        return _ok()
+
+    def iternext(self, req):
+        key = next(self._iter, None) if self._iter is not None else None
+        if key is None:
+            return _fail()
+        return _ok(_INT.pack(len(key)), key)
+
+    def fwmkeys(self, req):
+        psiz, maxkeys = req.int(), req.int()
+        prefix = req.str(psiz)
+        if maxkeys >= 1 << 31:
+            # Negative, no limit
+            maxkeys = None
+        keys = [k for k in self.factory.keys() if k.startswith(prefix)]
+        return _list(keys[:maxkeys])
+
+    def addint(self, req):
+        ksiz, num = req.int(), req.int()
+        key = req.str(ksiz)
+        db = self.factory.db
+        if num >= 1 << 31:
+            num -= 1 << 32
+        value = db.get(key)
+        if value is not None and len(value) != 4:
+            return _fail()
+        # Stored as a native int, as ttserver does
+        total = (struct.unpack('<i', value)[0] if value else 0) + num
+        db[key] = struct.pack('<i', total)
+        return _ok(_INT.pack(total & 0xffffffff))
+
+    def adddouble(self, req):
+        ksiz, intpart, fracpart = req.int(), req.long(), req.long()
+        key = req.str(ksiz)
+        db = self.factory.db
+        value = db.get(key)
+        if value is not None and len(value) != 8:
+            return _fail()
+        total = (struct.unpack('<d', value)[0] if value else 0.0) + \
+            intpart + fracpart * 1e-12
+        db[key] = struct.pack('<d', total)
+        intpart = int(total)
+        return _ok(_DOUBLE.pack(intpart, int((total - intpart) * 1e12)))
+
+    def sync(self, req):
+        return _ok()
+
+    def vanish(self, req):
+        self.factory.db.clear()
+        return _ok()
+
+    def rnum(self, req):
+        return _ok(_LONG.pack(len(self.factory.db)))
+
+    def size(self, req):
+        return _ok(_LONG.pack(self.factory.size()))
+
+    def stat(self, req):
+        stat = self.factory.stat()
+        return _ok(_INT.pack(len(stat)), stat)
+
+    def misc(self, req):
+        nsiz, opts, rnum = req.int(), req.int(), req.int()
+        name = req.str(nsiz)
+        args = [req.str(req.int()) for i in xrange(rnum)]
+        method = getattr(self, 'misc_' + name, None)
+        res = method(args) if method is not None else None
+        if res is None:
+            return _fail() + _INT.pack(0)
+        return _list(res)
+
+    # Misc functions, they return a list or None on failure
+
+    def _value(self, args):
+        if self.factory.dbtype == 'table':
+            # Columns and their values
+            return '\x00'.join(args[1:])
+        return args[1] if len(args) > 1 else ''
+
+    def misc_put(self, args):
+        self.factory.db[args[0]] = self._value(args)
+        return []
+
+    def misc_putkeep(self, args):
+        if args[0] in self.factory.db:
+            return None
+        return self.misc_put(args)
+
+    def misc_putcat(self, args):
+        db = self.factory.db
+        db[args[0]] = db.get(args[0], '') + self._value(args)
+        return []
+
+    def misc_out(self, args):
+        if self.factory.db.pop(args[0], None) is None:
+            return None
+        return []
+
+    def misc_get(self, args):
+        value = self.factory.db.get(args[0])
+        if value is None:
+            return None
+        if self.factory.dbtype == 'table':
+            return value.split('\x00')
+        return [value]
+
+    def misc_putlist(self, args):
+        self.factory.db.update(itertools.izip(args[::2], args[1::2]))
+        return []
+
+    def misc_outlist(self, args):
+        db = self.factory.db
+        for key in args:
+            db.pop(key, None)
+        return []
+
+    def misc_getlist(self, args):
+        db = self.factory.db
+        res = []
+        for key in args:
+            if key in db:
+                res.extend((key, db[key]))
+        return res
+
+    def misc_range(self, args):
+        begin = args[0] if args else ''
+        maxkeys = int(args[1]) if len(args) > 1 else -1
+        end = args[2] if len(args) > 2 else None
+        db = self.factory.db
+        res = []
+        for key in self.factory.keys(ordered=True):
+            if key < begin:
+                continue
+            if end is not None and key >= end or len(res) == 2 * maxkeys:
+                break
+            res.extend((key, db[key]))
+        return res
+
+    def misc_genuid(self, args):
+        self.factory.uid += 1
+        return [str(self.factory.uid)]
+
+    def misc_setindex(self, args):
+        return []
+
+    def misc_search(self, args):
+        conditions, order, limit, offset = [], None, None, 0
+        columns = None
+        action = None
+        for arg in args:
+            parts = arg.split('\x00')
+            if parts[0] == 'addcond':
+                conditions.append((parts[1], int(parts[2]), parts[3]))
+            elif parts[0] == 'setorder':
+                order = (parts[1], int(parts[2]))
+            elif parts[0] == 'setlimit':
+                limit, offset = int(parts[1]), int(parts[2])
+            elif parts[0] == 'get':
+                columns = parts[1:]
+            elif parts[0] in ('out', 'count'):
+                action = parts[0]
+
+        db = self.factory.db
+        found = []
+        for key in self.factory.keys():
+            cols = _columns(db[key])
+            cols[''] = key
+            if all(_match(cols, *cond) for cond in conditions):
+                found.append(cols)
+        if order is not None:
+            name, order_type = order
+            numeric = order_type in (TyrantProtocol.RDBQONUMASC,
+                                     TyrantProtocol.RDBQONUMDESC)
+            reverse = order_type in (TyrantProtocol.RDBQOSTRDESC,
+                                     TyrantProtocol.RDBQONUMDESC)
+            if numeric:
+                keyfunc = lambda cols: _number(cols.get(name))
+            else:
+                keyfunc = lambda cols: cols.get(name, '')
+            found.sort(key=keyfunc, reverse=reverse)
+        if limit is not None and limit >= 0:
+            found = found[offset:offset + limit]
+        elif offset:
+            found = found[offset:]
+
+        if action == 'count':
+            return [str(len(found))]
+        if action == 'out':
+            for cols in found:
+                del db[cols['']]
+            return []
+        if columns is None:
+            return [cols[''] for cols in found]
+        res = []
+        for cols in found:
+            key = cols.pop('')
+            names = columns or sorted(cols)
+            res.append('\x00'.join(
+                ['', key] + ['%s\x00%s' % (n, cols[n])
+                             for n in names if n in cols]))
+        return res
+
+    HANDLERS = {
+        TyrantProtocol.PUT: put,
+        TyrantProtocol.PUTKEEP: putkeep,
+        TyrantProtocol.PUTCAT: putcat,
+        TyrantProtocol.PUTSHL: putshl,
+        TyrantProtocol.PUTNR: putnr,
+        TyrantProtocol.OUT: out,
+        TyrantProtocol.GET: get,
+        TyrantProtocol.MGET: mget,
+        TyrantProtocol.VSIZ: vsiz,
+        TyrantProtocol.ITERINIT: iterinit,
+        TyrantProtocol.ITERNEXT: iternext,
+        TyrantProtocol.FWMKEYS: fwmkeys,
+        TyrantProtocol.ADDINT: addint,
+        TyrantProtocol.ADDDOUBLE: adddouble,
+        TyrantProtocol.SYNC: sync,
+        TyrantProtocol.VANISH: vanish,
+        TyrantProtocol.RNUM: rnum,
+        TyrantProtocol.SIZE: size,
+        TyrantProtocol.STAT: stat,
+        TyrantProtocol.MISC: misc,
+    }
+
+
+class FakeTyrantFactory(protocol.ServerFactory):
+    """Fake ttserver with an in-memory database of dbtype: "hash",
+    "B+ tree" (ordered keys, misc "range") or "table" (misc "search").
+    Replies are delayed by latency seconds and, if chunk_size is given,
+    written chunk_size bytes at a time, one chunk per reactor iteration.
+    """
+
+    protocol = FakeTyrant
+
+    def __init__(self, dbtype='hash', latency=0, chunk_size=None,
+                 clock=reactor):
+        self.dbtype = dbtype
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.clock = clock
+        self.db = {}
+        self.uid = 0
+
+    def keys(self, ordered=None):
+        """Keys in database order, sorted for B+ tree databases"""
+        if ordered or (ordered is None and self.dbtype == 'B+ tree'):
+            return sorted(self.db)
+        return list(self.db)
+
+    def size(self):
+        return sum(len(k) + len(v) for k, v in self.db.iteritems())
+
+    def stat(self):
+        return ''.join('%s\t%s\n' % item for item in (
+            ('type', self.dbtype), ('rnum', len(self.db)),
+            ('size', self.size()), ('time', '%.6f' % self.clock.seconds()),
+            ('rts', 0)))